@@ -4,6 +4,8 @@ from obspy.core.event.event import Event
 from obspy.core.inventory.inventory import Inventory
 
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 import numpy as np
 import math
@@ -13,13 +15,15 @@ import scipy.signal as signal
 from scipy import sparse
 
 from bowpy.util.array_util import epidist2nparray, attach_epidist2coords,\
-                                  alignon
-from bowpy.util.fkutil import ls2ifft_prep,\
+                                  alignon, gaps_fill_grid
+from bowpy.util.fkutil import ls2ifft_prep, nufft_fk, nufft_ifk, lsfk, ilsfk,\
                               slope_distribution, makeMask,\
-                              create_iFFT2mtx, pocs
+                              create_iFFT2operator, dcg_solver, pocs,\
+                              pocs_batch, pocs3d, fx_solver, to_shared_memory
 from bowpy.util.base import nextpow2, array2stream, stream2array,\
                             line_cut, line_set_zero
 from bowpy.util.picker import get_polygon
+from bowpy.util import fftutil
 
 
 def fk_filter(st, inv=None, event=None, ftype='eliminate',
@@ -27,7 +31,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
               normalize=True, stack=False, slopes=[-3, 3], deltaslope=0.05,
               slopepicking=False, smoothpicks=False, dist=0.5,
               maskshape=['boxcar', None], order=4., peakinput=False,
-              eval_mean=1, fs=25):
+              eval_mean=1, fs=25, nufft=False):
     """
     Import stream, the function applies an 2D FFT, removes a certain window
     around the desired phase to surpress a slownessvalue corresponding to a
@@ -51,13 +55,17 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
                  -extract
                  -eliminate-polygon
                  -extract-polygon
+                 -eliminate-ls
+                 -extract-ls
                  -mask
                  -fk
 
     type ftype: string
 
     param fshape: fshape[0] describes the shape of the fk-filter in case of
-                  ftype is 'eliminate' or 'extract'. Possible inputs are:
+                  ftype is 'eliminate' or 'extract', or their Lomb-Scargle
+                  versions 'eliminate-ls' and 'extract-ls' for traces at
+                  irregular distances. Possible inputs are:
                  -spike (default)
                  -boxcar
                  -taper
@@ -95,6 +103,12 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     param eval_mean: number of linear events used to calculate the average of
                      the area in the fk domain.
 
+    param nufft: If True, the f-k spectrum is computed directly from the irregular
+                 distances of the traces by a non-uniform FFT, see
+                 bowpy.util.fkutil.nufft_fk, no regular grid of traces is needed.
+                 Not used by ftype 'mask'.
+    type nufft: bool
+
     returns:	stream_filtered, the filtered stream.
 
 
@@ -128,7 +142,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     ArrayData = stream2array(st_tmp, normalize)
 
     ix = ArrayData.shape[0]
-    iK = int(math.pow(2, nextpow2(ix)))
+    iK = fftutil.fast_len(ix)
 
     try:
         yinfo = epidist2nparray(attach_epidist2coords(inv, event, st_tmp))
@@ -155,9 +169,32 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
             k_axis=None
 
     it     = ArrayData.shape[1]
-    iF     = int(math.pow(2,nextpow2(it)))
+    iF     = fftutil.fast_len(it)
     dt     = st_tmp[0].stats.delta
-    f_axis = np.fft.fftfreq(iF,dt)
+    f_axis = np.fft.rfftfreq(iF,dt)
+
+    if nufft or ftype in ('eliminate-ls', 'extract-ls'):
+        try:
+            xinfo = np.array([trace.stats.distance for trace in st_tmp])
+        except AttributeError:
+            if yinfo is None:
+                raise IOError('For nufft and the Lomb-Scargle filters the distances of the traces are needed, not found.')
+            xinfo = yinfo
+
+    if nufft:
+        # Least-squares spectrum of the traces at their distances, nufft_ifk is its inverse.
+        def fktransform(data):
+            return nufft_fk(data, xinfo, iK, iF, niter=30)
+
+        def ifktransform(fkdata):
+            return nufft_ifk(fkdata, xinfo, it)
+
+    else:
+        def fktransform(data):
+            return fftutil.rfft2(data, s=(iK,iF))
+
+        def ifktransform(fkdata):
+            return fftutil.irfft2(fkdata, s=(iK,iF))
 
 
 
@@ -171,6 +208,9 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
     # 2D f-k Transformation
     # Note array_fk has f on the x-axis and k on the y-axis!!!
+    # The data are real, so only the half spectrum along f is kept (rfft2),
+    # the filters are applied to it directly.
+    # The mask method works on the full spectrum, as slope_distribution and makeMask expect it.
     # For interaction the conj.-transposed Array is shown!!!
 
 
@@ -186,11 +226,11 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             array_filtered_fk = line_set_zero(array_fk, shape=fshape)
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             array_filtered_fk = line_set_zero(array_fk, shape=fshape)
 
     elif ftype in ("extract"):
@@ -201,23 +241,23 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             array_filtered_fk = line_cut(array_fk, shape=fshape)
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             array_filtered_fk = line_cut(array_fk, shape=fshape)
 
 
     elif ftype in ("eliminate-polygon"):
-        array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+        array_fk = fktransform(ArrayData)
         if phase:
             if not isinstance(event, Event) and not isinstance(inv, Inventory):
                 msg='For alignment on phase calculation inventory and event information is needed, not found.'
                 raise IOError(msg)
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             array_filtered_fk = _fk_eliminate_polygon(array_fk, polygon, ylabel=r'frequency domain f in Hz', \
                                                       yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
 
@@ -227,7 +267,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
 
     elif ftype in ("extract-polygon"):
-        array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+        array_fk = fktransform(ArrayData)
         if phase:
             if not isinstance(event, Event) and not isinstance(inv, Inventory):
                 msg='For alignment on phase calculation inventory and event information is needed, not found.'
@@ -235,7 +275,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             array_filtered_fk = _fk_extract_polygon(array_fk, polygon, ylabel=r'frequency domain f in Hz', \
                                                 yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
         else:
@@ -243,12 +283,22 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
                                                 yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
 
 
+    elif ftype in ("eliminate-ls", "extract-ls"):
+        if ftype in ("eliminate-ls"):
+            array_filtered = _fk_ls_filter_eliminate_phase_sp(ArrayData, xinfo, fshape, iF)
+        else:
+            array_filtered = _fk_ls_filter_extract_phase_sp(ArrayData, xinfo, fshape, iF)
+        stream_filtered = array2stream(array_filtered, st_original=st.copy())
+        stream_filtered.normalize()
+        return stream_filtered
+
+
     elif ftype in ("mask"):
-        array_fk = np.fft.fft2(ArrayData)
+        array_fk = fftutil.fft2(ArrayData)
         M, prange, peaks = slope_distribution(array_fk, slopes, deltaslope, peakpick=None, mindist=dist, smoothing=smoothpicks, interactive=slopepicking)
         W = makeMask(array_fk, peaks[0], maskshape)
         array_filtered_fk =  array_fk * W
-        array_filtered = np.fft.ifft2(array_filtered_fk)
+        array_filtered = fftutil.ifft2(array_filtered_fk)
         stream_filtered = array2stream(array_filtered, st_original=st.copy())
         return stream_filtered, array_fk, W
 
@@ -261,12 +311,12 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
             st_al = alignon(st_tmp, inv, event, phase)
             ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             ### BUILD DOUBLE TAPER ###
             #array_filtered_fk =
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = fktransform(ArrayData)
             ### BUILD DOUBLE TAPER ###
             #array_filtered_fk =
 
@@ -275,7 +325,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
         print("No type of filter specified")
         raise TypeError
 
-    array_filtered = np.fft.ifft2(array_filtered_fk, s=(iK,iF)).real
+    array_filtered = ifktransform(array_filtered_fk)
 
 
     # Convert to Stream object.
@@ -287,11 +337,66 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
 
 
+def fk_filter_batch(streams, ftype='eliminate', fshape=['butterworth', 2, 2], normalize=True):
+    """
+    Applies the line filters of fk_filter to several events recorded on the same array.
+    The streams are stacked to an array of shape (events, traces, samples), which is
+    transformed, filtered and transformed back at once.
+
+    :param streams: Streams of the events, with the same number of traces and samples
+    :type  streams: list
+
+    :param ftype: type of method, 'eliminate' or 'extract', see fk_filter
+    :type  ftype: string
+
+    :param fshape: shape of the fk-filter, see fk_filter
+    :type  fshape: list
+
+    :param normalize: normalize data to 1
+    :type  normalize: bool
+
+    returns:
+
+    :param st_filtered: filtered streams
+    :type  st_filtered: list
+    """
+    if len(fshape) == 1:
+        fshape = [fshape[0], None, None]
+
+    data = _stack_streams(streams, normalize)
+    nev, ix, it = data.shape
+    iK, iF = fftutil.fast_shape((ix, it))
+
+    # The line filters act along the first axis, so k is moved in front of the events.
+    array_fk = fftutil.rfft2(data, s=(iK,iF)).transpose(1, 0, 2)
+
+    if ftype in ("eliminate"):
+        array_filtered_fk = line_set_zero(array_fk, shape=fshape)
+
+    elif ftype in ("extract"):
+        array_filtered_fk = line_cut(array_fk, shape=fshape)
+
+    else:
+        print("No type of filter specified")
+        raise TypeError
+
+    array_filtered = fftutil.irfft2(array_filtered_fk.transpose(1, 0, 2), s=(iK,iF))[:, 0:ix, 0:it]
+
+    st_filtered = []
+    for st, array in zip(streams, array_filtered):
+        stream_filtered = array2stream(array, st_original=st.copy())
+        stream_filtered.normalize()
+        st_filtered.append(stream_filtered)
+
+    return st_filtered
+
+
 """
 FFT FUNCTIONS
 """
 def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smoothpicks=False, dist=0.5, maskshape=['boxcar',None],
-                    method='denoise', solver="iterative",  mu=5e-2, tol=1e-12, fulloutput=False, peakinput=False, alpha=0.9):
+                    method='denoise', solver="iterative",  mu=5e-2, tol=1e-12, fulloutput=False, peakinput=False, alpha=0.9,
+                    workers=None, callback=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros, and its Mask-array (see makeMask, and slope_distribution.
@@ -310,7 +415,8 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
 
 
     Minimizing is done via a method of the LSMR solver, de-noising (1-2 iterations), reconstruction(8-10) iterations.
-    T FHmtx2D Yw Dv will be formed to one matrix A, so at the end the equation system that will be solved has the form:
+    T FHmtx2D Yw Dv will be formed to one matrix-free operator A, applied via 2D FFTs,
+    so at the end the equation system that will be solved has the form:
 
                             |   A    |		  | dv |
                             |    	 | * Dv = |    |
@@ -353,8 +459,11 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     :param method: Desired fk-method, options are 'denoise' and 'interpolate'
     :type  method: string
 
-    :param solver: Solver used for method. Options are 'lsqr' and 'iterative'.
+    :param solver: Solver used for method. Options are 'lsqr', 'iterative', 'cg' and 'fx'.
                    If method is 'denoise' only the iterative solver is used.
+                   'cg' runs the matrix-free damped CGLS of bowpy.util.fkutil.dcg_solver.
+                   'fx' solves the damped problem exactly for each frequency slice,
+                   see bowpy.util.fkutil.fx_solver.
     :type  solver: string
 
     :param mu:	Damping parameter for the solver
@@ -363,12 +472,18 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     :param tol: Tolerance for solver to abort iteration.
     :type  tol: float
 
-    :param fulloutput: If True, the function additionally outputs FH, dv, Dv, Ts and Yw
+    :param fulloutput: If True, the function additionally outputs FH, dv, Dv, Dv_rec, Ts, Yw and W
     :type  fulloutput: bool
 
     :param peakinput: Chosen peaks of the distribution, insert here if the peaks are not to be meant to recalculated
     :type  peakinput: np.ndarray
 
+    :param workers: Number of threads used by the 'fx' solver
+    :type  workers: int
+
+    :param callback: Function called after each 'cg' iteration as callback(k, x, rnorm)
+    :type  callback: function
+
     ######  returns:
 
     :param st_rec: Stream with reconstructed signals on the missing traces
@@ -379,8 +494,9 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     :param st_rec: Stream with reconstructed signals on the missing traces
     :type  st_rec: obspy.core.stream.Stream
 
-    :param FH: 2DiFFT-matrix for column-wise ordered longvector of the f-k spectrum
-    :type  FH: scipy.sparse.csc.csc_matrix
+    :param FH: 2DiFFT-operator for column-wise ordered longvector of the f-k spectrum,
+               see bowpy.util.fkutil.create_iFFT2operator
+    :type  FH: scipy.sparse.linalg.LinearOperator
 
     :param dv: Column-wise ordered longvector of the t-x data
     :type  dv: numpy.ndarray
@@ -424,8 +540,8 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     ArrayData	= stream2array(st_tmp, normalize=False)
     ADT 		= ArrayData.copy().transpose()
 
-    fkData 		= np.fft.fft2(ArrayData)
-    fkDT 		= np.fft.fft2(ADT)
+    fkData 		= fftutil.fft2(ArrayData)
+    fkDT 		= fftutil.fft2(ADT)
 
     # Look for missing Traces
     recon_list 	= []
@@ -528,15 +644,14 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
         Ts = sparse.diags(T)
 
 
-        # Create sparse-matrix with iFFT operations.
-        print("Creating iFFT2 operator as a %ix%i matrix ...\n" %(fkDT.shape[0]*fkDT.shape[1], fkDT.shape[0]*fkDT.shape[1]))
-
-        FH = create_iFFT2mtx(fkDT.shape[0], fkDT.shape[1])
-        print("... finished\n")
-
-        # Create model matrix A.
-        print("Creating sparse %ix%i matrix A ...\n" %(FH.shape[0], FH.shape[1]))
-        A =  Ts.dot(FH.dot(Yw))
+        # Create matrix-free iFFT2 operators, FH alone and the model operator
+        # A = Ts FH Yw, both evaluated via FFTs. The unknowns of A are restricted
+        # to the support of the mask, the solution is scattered back into Dv_rec.
+        support = np.nonzero(Y)[0]
+        FH = create_iFFT2operator(fkData.shape)
+        A = create_iFFT2operator(fkData.shape, T=T, Y=Y, support=support)
+        Dv_rec = np.zeros(Dv.size, dtype='complex')
+        print("Solving for %i of %i coefficients\n" % (support.size, Dv.size))
         print("Starting reconstruction...\n")
 
         if solver in ("lsqr", "leastsquares"):
@@ -548,31 +663,24 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
             print("Misfit ||Ax - b||_2= %f \n" % x[4])
             print("Condition number = %f \n" % x[6])
 
-            Dv_rec = x[0]
+            Dv_rec[support] = x[0]
 
         elif solver in ("ilsmr", "iterative"):
             print(" ...using iterative LSMR solver...\n")
-            x = sparse.linalg.lsmr(A,dv,mu, atol=tol, btol=tol, conlim=tol, maxiter=maxiter)
+            x = sparse.linalg.lsmr(A,dv.astype('complex'),mu, atol=tol, btol=tol, conlim=tol, maxiter=maxiter)
             print("istop = %i \n" % x[1])
             print("Used iterations = %i \n" % x[2])
             print("Misfit = %f \n " % x[3])
             print("Modelnorm = %f \n" % x[4])
             print("Condition number = %f \n" % x[5])
             print("Norm of Dv = %f \n" % x[6])
-            Dv_rec = x[0]
+            Dv_rec[support] = x[0]
 
         elif solver in ("cg"):
-            A 		= Ts.dot(FH.dot(Yw))
-            Ah 		= A.conjugate().transpose()
-            madj 	= Ah.dot(dv)
-            E 		= mu * sparse.eye(A.shape[0])
-            B 		= A + E
-            Binv 	= sparse.linalg.inv(B)
-            x 		= sparse.linalg.cg(Binv, madj, maxiter=maxiter)
-            Dv_rec 	= x[0]
+            print(" ...using damped CGLS solver...\n")
+            Dv_rec[support] = dcg_solver(A, dv, mu, maxiter, tol=tol, callback=callback)
 
         elif solver in ('fmin'):
-            A 		= Ts.dot(FH.dot(Yw))
             global arg1
             global arg2
             global arg3
@@ -584,9 +692,15 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
                 COST = np.linalg.norm(arg1 - arg2.dot(x), 2)**2. + arg3*np.linalg.norm(x,2)**2.
                 return COST
 
-            Dv_rec = sp.optimize.fmin_cg(J, x0=Dv, maxiter=10)
+            Dv_rec[support] = sp.optimize.fmin_cg(J, x0=Dv[support], maxiter=10)
+
+        data_rec = fftutil.ifft2(Dv_rec.reshape(fkData.shape)).real
 
-        data_rec = np.fft.ifft2(Dv_rec.reshape(fkData.shape)).real
+    elif solver in ("fx",):
+        pocs = False
+        print(" ...using per-frequency damped least-squares solver...\n")
+        fkrec = fx_solver(ArrayData, W, recon_list, mu, workers)
+        data_rec = fftutil.ifft2(fkrec).real
 
     elif solver in ("pocs"):
         pocs=True
@@ -594,13 +708,13 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
 
         for i in range(maxiter):
             data_tmp 								= ArrayData.copy()
-            fkdata 									= np.fft.fft2(data_tmp) * W.astype('complex')
+            fkdata 									= fftutil.fft2(data_tmp) * W.astype('complex')
             fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
             threshold = threshold * alpha
             #if i % 10 == 0.:
             #	plt.imshow(abs(fkdata), aspect='auto', interpolation='none')
             #	plt.savefig("%s.png" % i)
-            data_tmp 								= np.fft.ifft2(fkdata).real.copy()
+            data_tmp 								= fftutil.ifft2(fkdata).real.copy()
             ArrayData[recon_list] 					= data_tmp[recon_list]
 
         data_rec = ArrayData.copy()
@@ -620,13 +734,14 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
     else:
         st_rec = array2stream(data_rec, st)
 
-    if fulloutput and not pocs:
+    if fulloutput and not pocs and solver not in ("fx",):
         return st_rec, FH, dv, Dv, Dv_rec, Ts, Yw, W
     else:
         return st_rec
 
 def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='linear', beta=None, peaks=None, maskshape=None,
-               dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, alpha_i_test=False, st_org=None, plotfeedback=False):
+               dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, alpha_i_test=False, st_org=None, plotfeedback=False,
+               tol=None, workers=None, x0=None, threshold=None, multigrid=None, seed=0, taperrange=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros. It applies the projection onto convex sets (pocs) algorithm in
@@ -643,6 +758,40 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
     :param nol: Number of loops
     :type  nol:
 
+    :param tol: Tolerance to stop the iteration early, see bowpy.util.fkutil.pocs_engine
+    :type  tol: float
+
+    :param alpha_i_test: If True, alpha and maxiter with the highest quality Q are taken from a
+                         grid, see pocs_q_surface. If 'search', they are searched, see pocs_q_search.
+                         If 'cv', they are taken from a grid by cross-validation on st, no st_org
+                         is needed, see pocs_cv.
+    :type  alpha_i_test: bool or str
+
+    :param workers: Number of processes of the alpha_i_test, see pocs_q_surface
+    :type  workers: int
+
+    :param taperrange: Minimum and maximum of maskshape[1], searched together with alpha and
+                       maxiter for alpha_i_test='search', see pocs_q_search
+    :type  taperrange: tuple
+
+    :param seed: Seed of the hidden traces of alpha_i_test='cv', see pocs_cv
+    :type  seed: int
+
+    :param x0: Initial guess of the missing traces, e.g. the reconstruction of the previous
+               time window or of a nearby event on the same array, with the same number of
+               traces and samples as st, in the units of st. It is scaled by the same
+               factor as st, the maximum of st.
+    :type  x0: obspy.core.stream.Stream or numpy.ndarray
+
+    :param threshold: Start threshold, relative to the maximum of the f-k spectrum, default
+                      is 1. Together with x0, a lower start needs fewer iterations, see
+                      bowpy.util.fkutil.pocs
+    :type  threshold: float
+
+    :param multigrid: Number of levels of a coarse-to-fine reconstruction, the traces are
+                      first reconstructed decimated in time, see bowpy.util.fkutil.pocs_multigrid
+    :type  multigrid: int
+
     returns:
 
     :param st_rec:
@@ -650,72 +799,79 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
     """
     if not maxiter and not alpha and not alpha_i_test:
         raise IOError('One of maxiter, alpha or alpha_i_test has to be chosen')
-    if alpha_i_test and not st_org:
+    if alpha_i_test and alpha_i_test not in ('cv',) and not st_org:
         raise IOError('For alpha_i_test an orignal stream is needed')
 
 
     st_tmp 		= st.copy()
     ArrayData 	= stream2array(st_tmp, normalize=True)
-    recon_list 	= []
-
-    if dmethod in ('reconstruct'):
-        for i, trace in enumerate(st_tmp):
-            try:
-                if trace.stats.zerotrace in ['True']:
-                    recon_list.append(i)
-
-            except AttributeError:
-                if sum(trace.data) == 0. :
-                    recon_list.append(i)
-
-            except:
-                continue
-
-        noft = recon_list
-
-    elif dmethod in ('denoise', 'de-noise'):
-        noft = range(ArrayData.shape[0])
-
-    if alpha_i_test:
+    noft 		= _pocs_noft(st_tmp, dmethod)
+
+    if x0 is not None:
+        if isinstance(x0, Stream):
+            x0 = stream2array(x0.copy())
+        scale = np.nanmax(stream2array(st_tmp))
+        if scale == 0:
+            scale = 1.
+        x0 = np.asarray(x0, dtype='float') / scale
+
+    if alpha_i_test in ('cv',):
+        alpha, maxiter, Qmax, Qall = pocs_cv(st, np.linspace(50,99,11)/100., np.arange(5,50), method=method,
+                                             dmethod=dmethod, beta=beta, peaks=peaks, maskshape=maskshape, dt=dt,
+                                             p=p, flow=flow, fhigh=fhigh, slidingwindow=slidingwindow, tol=tol,
+                                             workers=workers, seed=seed)
+
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow,
+                       tol=tol, x0=x0, threshold=threshold, multigrid=multigrid)
+
+    elif alpha_i_test:
         ADref = stream2array(st_org)
 
         if ADref.shape != ArrayData.shape:
             raise IOError('Shapes of reference stream and reconstructed stream differ!')
 
-        alpha_range = np.linspace(50,99,11)/100.
-        i_range		= np.flipud(np.arange(5,50))
-        test_length = float(alpha_range.size * i_range.size)
-        curr_step = 1.
-
-        alpha = 0.
-        maxiter = max(i_range)
-        Qmax = 0.
-        for i in i_range:
-            for a in alpha_range:
-                ADrec = pocs(ArrayData, i, noft, a, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback)
-                Q = 10.*np.log( np.linalg.norm(ADref,2)**2. / np.linalg.norm(ADref - ADrec,2)**2. )
-
-                if Q >= Qmax: # and maxiter > i:
-                    alpha = a
-                    maxiter = i
-                    Qmax = Q
+        if alpha_i_test in ('search',):
+            alpha, maxiter, taper, Qmax, Qall = pocs_q_search(st, ADref, (0.5, 0.99), (5, 49), taperrange, False,
+                                                              method, dmethod, beta, peaks, maskshape, dt, p, flow,
+                                                              fhigh, slidingwindow, tol)
+            if taper is not None:
+                maskshape = [maskshape[0], taper]
 
-                progress = 100. * (curr_step / test_length)
-                curr_step += 1.
-                print ('Progress of alpha-i test: %i %%, current Q: %f, current Qmax: %f' % ( int(progress),Q ,Qmax ), end='\r')
-                sys.stdout.flush()
-
-        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow)
+        else:
+            alpha_range = np.linspace(50,99,11)/100.
+            i_range		= np.flipud(np.arange(5,50))
+
+            Qall = pocs_q_surface(st, alpha_range, i_range, ADref, False, method, dmethod, beta, peaks, maskshape,
+                                  dt, p, flow, fhigh, slidingwindow, tol, workers)
+            Qsurf = dict(((a, i), Q) for a, i, Q in Qall)
+
+            alpha = 0.
+            maxiter = max(i_range)
+            Qmax = 0.
+            for i in i_range:
+                for a in alpha_range:
+                    Q = Qsurf[(a, i)]
+                    if Q >= Qmax: # and maxiter > i:
+                        alpha = a
+                        maxiter = i
+                        Qmax = Q
+
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow,
+                       tol=tol, x0=x0, threshold=threshold, multigrid=multigrid)
 
     else:
-        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback)
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow,
+                       plotfeedback=plotfeedback, tol=tol, x0=x0, threshold=threshold, multigrid=multigrid)
 
     #datap = ADfinal.copy()
 
     st_rec 	= array2stream(ADfinal, st)
     st_rec.normalize()
 
-    if alpha_i_test:
+    if alpha_i_test in ('search',):
+        for trace in st_rec:
+            trace.stats.pocs =  {'alpha': alpha, 'iteration': maxiter, 'Q': Qmax, 'taper': taper}
+    elif alpha_i_test:
         for trace in st_rec:
             trace.stats.pocs =  {'alpha': alpha, 'iteration': maxiter, 'Q': Qmax}
     else:
@@ -726,146 +882,673 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
 
     return st_rec
 
-def _fk_extract_polygon(data, polygon, xlabel=None, xticks=None, ylabel=None, yticks=None, eval_mean=1, fs=25):
+def pocs_recon_batch(streams, maxiter, alpha, dmethod='reconstruct', method='linear', noft=None, tol=None):
     """
-    Only use with the function fk_filter!
-    Function to test the fk workflow with synthetic data
-    param data:	data of the array
-    type data:	numpy.ndarray
+    Reconstructs the missing traces of several events recorded on the same array with
+    the pocs algorithm, see pocs_recon. The streams are stacked to an array of shape
+    (events, traces, samples), which is reconstructed at once by
+    bowpy.util.fkutil.pocs_batch. Only the methods 'linear' and 'exp' are supported.
+
+    :param streams: Streams of the events, with the same number of traces and samples
+    :type  streams: list
+
+    :param maxiter: Maximum number of iterations
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param noft: Indices of the traces to be reconstructed in all events, or a boolean
+                 array of shape (events, traces). Default are the zero traces of each
+                 stream.
+    :type  noft: list or numpy.ndarray
+
+    :param tol: Tolerance to stop the iteration early, see bowpy.util.fkutil.pocs_engine
+    :type  tol: float
+
+    returns:
+
+    :param st_rec: reconstructed streams
+    :type  st_rec: list
     """
-    # Shift 0|0 f-k to center, for easier handling
-    dsfk = np.fft.fftshift(data.conj().transpose())
-    dsfk_tmp = dsfk[0:dsfk.shape[0]/2]
+    if method not in ('linear', 'exp'):
+        raise IOError('Only the methods linear and exp are supported')
+    if dmethod in ('denoise', 'de-noise'):
+        raise IOError('Under Construction')
+
+    ArrayData = _stack_streams(streams, normalize=True)
+    if noft is None:
+        noft = np.zeros(ArrayData.shape[:2], dtype='bool')
+        for i, st in enumerate(streams):
+            noft[i, _pocs_noft(st, dmethod)] = True
+
+    ADfinal, niter = pocs_batch(ArrayData, noft, maxiter, alpha, method, tol=tol)
+
+    missing = np.zeros(ArrayData.shape[:2], dtype='bool')
+    if np.asarray(noft).dtype == bool:
+        missing[:] = noft
+    else:
+        missing[:, noft] = True
+
+    st_rec = []
+    for i, st in enumerate(streams):
+        st_tmp = array2stream(ADfinal[i], st)
+        st_tmp.normalize()
+        for trace in st_tmp:
+            trace.stats.pocs = {'alpha': alpha, 'iteration': int(niter[i])}
+        for trace in np.flatnonzero(missing[i]):
+            st_tmp[trace].stats.recon = True
+        st_rec.append(st_tmp)
+
+    return st_rec
+
+def pocs_recon3d(st, inv, maxiter, alpha, method='linear', spacing=None, patch=None, overlap=0.5, tol=None,
+                 workers=None, threshold=None):
+    """
+    Reconstructs the traces of a 2D array of stations in the (ky, kx, f) domain with the
+    pocs algorithm. The stations are placed on a regular grid by
+    bowpy.util.array_util.gaps_fill_grid and all empty cells are reconstructed at once
+    by bowpy.util.fkutil.pocs3d, instead of reconstructing 1D distance profiles.
+
+    :param st: Stream of the array
+    :type  st: obspy.core.stream.Stream
+
+    :param inv: Inventory with the coordinates of the stations
+    :type  inv: obspy.core.inventory.inventory.Inventory
+
+    :param maxiter: Maximum number of iterations
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param spacing: Spacing of the grid in degrees, see gaps_fill_grid
+    :type  spacing: float
+
+    :param patch: Size (y, x, samples) of the patches, default is the whole grid,
+                  see bowpy.util.fkutil.pocs_tiled
+    :type  patch: tuple
+
+    :param tol: Tolerance to stop the iteration early, see bowpy.util.fkutil.pocs_engine
+    :type  tol: float
+
+    returns:
+
+    :param st_rec: Reconstructed traces of all cells of the grid, in row-major order of
+                   (y, x), with their coordinates in stats.coordinates
+    :type  st_rec: obspy.core.stream.Stream
+    """
+    st_grid, shape = gaps_fill_grid(st, inv, spacing)
+    ArrayData 	= stream2array(st_grid, normalize=True)
+    noft 		= np.zeros(len(st_grid), dtype='bool')
+    noft[_pocs_noft(st_grid, 'reconstruct')] = True
+
+    ADfinal = pocs3d(ArrayData.reshape(shape + (-1,)), maxiter, alpha, noft.reshape(shape), method, patch,
+                     overlap, tol, workers, threshold)
+
+    st_rec 	= array2stream(ADfinal.reshape(ArrayData.shape), st_grid)
+    st_rec.normalize()
+
+    for trace in st_rec:
+        trace.stats.pocs = {'alpha': alpha, 'iteration': maxiter}
+    for trace in np.flatnonzero(noft):
+        st_rec[trace].stats.recon = True
+
+    return st_rec
+
+def pocs_q_surface(st, alpharange, irange, ADref, normalize=False, method='linear', dmethod='reconstruct', beta=None,
+                   peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, tol=None,
+                   workers=None):
+    """
+    Evaluates the quality Q of the pocs reconstruction of st for every alpha in alpharange
+    and every number of iterations in irange, see pocs_q.
+
+    For 'linear' and 'exp' with dmethod 'reconstruct' the run with i iterations is the
+    first part of the run with max(irange) iterations. So only one run per alpha is done,
+    and Q is evaluated after every iteration, with the same results as separate runs.
+    All other methods are run separately for every alpha and i.
+
+    With workers > 1 the runs are distributed on a pool of processes. The data of st and
+    ADref are placed once in shared memory, the processes only return the Q values.
+
+    :param st: Stream with the gaps, see pocs_recon
+    :type  st: obspy.core.stream.Stream
+
+    :param alpharange: Values of alpha
+    :type  alpharange: numpy.ndarray
+
+    :param irange: Numbers of iterations
+    :type  irange: numpy.ndarray
+
+    :param ADref: Reference array data, without gaps
+    :type  ADref: numpy.ndarray
+
+    :param normalize: Normalize the reconstruction as pocs_recon returns it, see pocs_q
+    :type  normalize: bool
+
+    :param workers: Number of processes, default is a serial run
+    :type  workers: int
+
+    For the other parameters see pocs_recon.
+
+    returns:
+
+    :param Qall: List of [alpha, i, Q], as used by bowpy.util.tests.qtest_plot
+    :type  Qall: list
+    """
+    ArrayData 	= stream2array(st, normalize=True)
+    noft 		= _pocs_noft(st, dmethod)
+    ADref 		= np.asarray(ADref, dtype='float')
+    irange 		= np.asarray(irange)
+
+    pocsargs = dict(beta=beta, method=method, dmethod=dmethod, peaks=peaks, maskshape=maskshape, dt=dt, p=p,
+                    flow=flow, fhigh=fhigh, slidingwindow=slidingwindow, tol=tol)
+
+    tasks = [(alpha, itask, None) for alpha in alpharange for itask in _pocs_q_split(irange, pocsargs)]
+    Qtasks = _pocs_q_map(ArrayData, ADref, noft, tasks, normalize, pocsargs, workers)
+
+    Qall = []
+    for (alpha, itask, hidden), Qs in zip(tasks, Qtasks):
+        for i, Q in zip(itask, Qs):
+            Qall.append([alpha, i, Q])
+
+    return Qall
 
-    # Define polygon by user-input.
-    # If eval_mean is true, select area where to calculate the mean value
-    if eval_mean != 1:
-        indicies_eval 				= get_polygon(abs(dsfk_tmp), 4, xlabel, xticks, ylabel, yticks)
-        dsfk_eval 					= dsfk
-        dsfk_eval.conj().transpose().flat[ indicies_eval ] = dsfk_eval.conj().transpose().flat[ indicies_eval ] / float(eval_mean)
-        dsfk_tmp 					= dsfk_eval.copy()
 
-    #indicies = get_polygon(np.log(abs(dsfk)), polygon, xlabel, xticks, ylabel, yticks)
-    indicies = get_polygon(abs(dsfk_tmp), polygon, xlabel, xticks, ylabel, yticks, fs)
+def pocs_cv(st, alpharange, irange, nfolds=5, nhide=None, seed=0, method='linear', dmethod='reconstruct',
+            beta=None, peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False,
+            tol=None, workers=None):
+    """
+    Evaluates the pocs reconstruction of st by cross-validation, without a reference stream.
+    In each of nfolds folds a random subset of nhide live traces is set to zero and
+    reconstructed together with the gaps of st, for every alpha in alpharange and number of
+    iterations in irange. The quality Q of the hidden traces with respect to their original
+    data (see pocs_q) is averaged over the folds.
+
+    The runs are done as in pocs_q_surface, with workers > 1 on a pool of processes.
+
+    :param st: Stream with the gaps, see pocs_recon
+    :type  st: obspy.core.stream.Stream
+
+    :param alpharange: Values of alpha
+    :type  alpharange: numpy.ndarray
+
+    :param irange: Numbers of iterations
+    :type  irange: numpy.ndarray
+
+    :param nfolds: Number of folds
+    :type  nfolds: int
+
+    :param nhide: Number of traces hidden in each fold, default is the number of gaps in st
+    :type  nhide: int
+
+    :param seed: Seed of the random choice of the hidden traces, fixed by default so that
+                 the same call selects the same parameters. None draws new folds each call.
+    :type  seed: int
+
+    For the other parameters see pocs_q_surface and pocs_recon.
+
+    returns:
+
+    :param alpha, maxiter, Qmax: Parameters with the highest mean Q, and the mean Q
+    :param Qall: List of [alpha, i, mean Q], as used by bowpy.util.tests.qtest_plot
+    """
+    ArrayData 	= stream2array(st, normalize=True)
+    noft 		= _pocs_noft(st, dmethod)
+    irange 		= np.asarray(irange)
+    live 		= np.setdiff1d(np.arange(ArrayData.shape[0]), noft)
+
+    if not nhide:
+        nhide = max(1, len(noft))
+    if nhide >= live.size:
+        raise IOError('Not enough live traces to hide %i traces' % nhide)
+
+    rng = np.random.RandomState(seed)
+    folds = [np.sort(rng.choice(live, nhide, replace=False)) for n in range(nfolds)]
+
+    pocsargs = dict(beta=beta, method=method, dmethod=dmethod, peaks=peaks, maskshape=maskshape, dt=dt, p=p,
+                    flow=flow, fhigh=fhigh, slidingwindow=slidingwindow, tol=tol)
+
+    tasks = [(alpha, itask, hidden) for alpha in alpharange for itask in _pocs_q_split(irange, pocsargs)
+             for hidden in folds]
+    Qtasks = _pocs_q_map(ArrayData, None, noft, tasks, False, pocsargs, workers)
+
+    Qsum = {}
+    for (alpha, itask, hidden), Qs in zip(tasks, Qtasks):
+        for i, Q in zip(itask, Qs):
+            Qsum[(alpha, i)] = Qsum.get((alpha, i), 0.) + Q / float(nfolds)
+
+    Qall = []
+    for alpha in alpharange:
+        for i in irange:
+            Qall.append([alpha, i, Qsum[(alpha, i)]])
+
+    alpha, maxiter, Qmax = max(Qall, key=lambda item: item[2])
+
+    return alpha, maxiter, Qmax, Qall
+
+
+def _pocs_q_split(irange, pocsargs):
+    """
+    Splits irange into the parts evaluated by one task: all of it, if the runs of
+    one alpha share their iterations, single numbers of iterations otherwise.
+    """
+    if pocsargs['method'] in ('linear', 'exp') and pocsargs['dmethod'] in ('reconstruct', 'Reconstruct') \
+       and not pocsargs['slidingwindow']:
+        return [irange]
+    return [irange[[j]] for j in range(irange.size)]
+
+
+def _pocs_q_map(ArrayData, ADref, noft, tasks, normalize, pocsargs, workers=None):
+    """
+    Runs the tasks (alpha, irange, hidden) of _pocs_q_task, serially or with workers > 1
+    on a pool of processes, with ArrayData and ADref in shared memory. If ADref is None,
+    ArrayData is the reference. Returns the list of Q values of each task.
+    """
+    if not workers or workers == 1:
+        Qtasks = []
+        for ti, (alpha, itask, hidden) in enumerate(tasks):
+            print('Progress of alpha-i test: %i of %i runs' % (ti+1, len(tasks)), end='\r')
+            sys.stdout.flush()
+            Qtasks.append(_pocs_q_task(ArrayData, ADref, noft, alpha, itask, normalize, pocsargs, hidden))
+        return Qtasks
+
+    blocks = [to_shared_memory(ArrayData)]
+    ref = None
+    if ADref is not None:
+        blocks.append(to_shared_memory(ADref))
+        ref = (blocks[1].name, ADref.shape)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_pocs_q_init,
+                                 initargs=((blocks[0].name, ArrayData.shape), ref,
+                                           noft, normalize, pocsargs)) as executor:
+            Qtasks = list(executor.map(_pocs_q_shared_task, *zip(*tasks)))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return Qtasks
+
+
+def pocs_q_search(st, ADref, alpharange=(0.5, 0.99), irange=(5, 49), taperrange=None, normalize=False,
+                  method='linear', dmethod='reconstruct', beta=None, peaks=None, maskshape=None, dt=None, p=None,
+                  flow=None, fhigh=None, slidingwindow=False, tol=None, xtol=0.01, rounds=2):
+    """
+    Searches the alpha, number of iterations and mask taper with the highest quality Q of the
+    pocs reconstruction of st (see pocs_q), instead of evaluating a full grid as
+    pocs_q_surface does.
+
+    The parameters are found by golden-section searches, one parameter at a time, for
+    'rounds' rounds. For 'linear' and 'exp' with dmethod 'reconstruct' every evaluated alpha
+    is one pocs run, Q is evaluated after every iteration and the best number of iterations
+    is picked from it. For all other methods the number of iterations is searched over the
+    integers, alternating with alpha. If taperrange is given, the second entry of maskshape
+    is searched as well. A Q with a single maximum in each parameter is assumed.
+
+    :param st: Stream with the gaps, see pocs_recon
+    :type  st: obspy.core.stream.Stream
+
+    :param ADref: Reference array data, without gaps
+    :type  ADref: numpy.ndarray
+
+    :param alpharange: Minimum and maximum of alpha
+    :type  alpharange: tuple
+
+    :param irange: Minimum and maximum number of iterations
+    :type  irange: tuple
+
+    :param taperrange: Minimum and maximum of maskshape[1], only for the mask methods.
+                       Integer values are searched for the boxcar lobes.
+    :type  taperrange: tuple
+
+    :param xtol: Tolerance of the search, relative to the size of the range
+    :type  xtol: float
+
+    :param rounds: Number of rounds of the searches
+    :type  rounds: int
+
+    For the other parameters see pocs_q_surface and pocs_recon.
+
+    returns:
+
+    :param alpha, maxiter, taper, Qmax: Parameters with the highest Q, and the Q
+    :param Qall: List of the evaluated [alpha, i, Q], can be plotted with
+                 bowpy.util.tests.qtest_plot, using the unique values of alpha and i
+                 as alpharange and irange.
+    """
+    ArrayData 	= stream2array(st, normalize=True)
+    noft 		= _pocs_noft(st, dmethod)
+    ADref 		= np.asarray(ADref, dtype='float')
+    imin, imax 	= int(irange[0]), int(irange[1])
+    trajectory 	= method in ('linear', 'exp') and dmethod in ('reconstruct', 'Reconstruct') and not slidingwindow
+
+    if taperrange is not None:
+        taper = maskshape[1]
+        itaper = maskshape[0] in ['boxcar']
+    else:
+        taper = None
+
+    Qall = []
+    cache = {}
+
+    def evaluate(alpha, i, taper):
+        # Returns Q and the number of iterations for alpha, i and taper. Runs along
+        # the iterations return the highest Q of the run instead.
+        key = (alpha, taper) if trajectory else (alpha, i, taper)
+        if key in cache:
+            return cache[key]
+
+        shape = maskshape
+        if taper is not None:
+            shape = [maskshape[0], taper]
+        pocsargs = dict(beta=beta, method=method, dmethod=dmethod, peaks=peaks, maskshape=shape, dt=dt, p=p,
+                        flow=flow, fhigh=fhigh, slidingwindow=slidingwindow, tol=tol)
+
+        if trajectory:
+            iall = np.arange(imin, imax+1)
+            Qs = _pocs_q_task(ArrayData, ADref, noft, alpha, iall, normalize, pocsargs)
+            Qall.extend([alpha, n, Q] for n, Q in zip(iall, Qs))
+            j = int(np.argmax(Qs))
+            cache[key] = (Qs[j], int(iall[j]))
+        else:
+            Q = _pocs_q_task(ArrayData, ADref, noft, alpha, np.array([i]), normalize, pocsargs)[0]
+            Qall.append([alpha, i, Q])
+            cache[key] = (Q, i)
 
-    # Create new array, only contains extractet energy, pointed to with indicies
-    dsfk_extract 										= np.zeros(dsfk_tmp.shape)
-    dsfk_extract.conj().transpose().flat[ indicies ] 	= 1.
-    dsfk_tmp = dsfk_tmp * dsfk_extract
-    data_fk = np.zeros(dsfk.shape).astype('complex')
+        print('Search of alpha-i: %i runs, current Q: %f' % (len(cache), cache[key][0]), end='\r')
+        sys.stdout.flush()
 
-    #top half of domain.
-    data_fk[0:dsfk.shape[0]/2] 	= dsfk_tmp
+        return cache[key]
 
-    #Bottom half of domain, exploiting symmetry and shift properties.
-    data_fk[dsfk.shape[0]/2:] 		= np.roll(np.roll(np.flipud(np.fliplr(dsfk_tmp)),1).transpose(), 1).transpose()
+    alpha = (alpharange[0] + alpharange[1]) / 2.
+    maxiter = (imin + imax) // 2
+    for r in range(int(rounds)):
+        alpha = _golden_max(lambda a: evaluate(a, maxiter, taper)[0], alpharange[0], alpharange[1],
+                            xtol * abs(alpharange[1] - alpharange[0]))[0]
+        if not trajectory:
+            maxiter = _golden_max(lambda n: evaluate(alpha, n, taper)[0], imin, imax, integer=True)[0]
+        if taperrange is not None:
+            taper = _golden_max(lambda t: evaluate(alpha, maxiter, t)[0], taperrange[0], taperrange[1],
+                                xtol * abs(taperrange[1] - taperrange[0]), integer=itaper)[0]
+        elif trajectory:
+            break
 
-    data_fk = np.fft.ifftshift(data_fk.conj().transpose())
+    Qmax, maxiter = evaluate(alpha, maxiter, taper)
 
-    return data_fk
+    return alpha, maxiter, taper, Qmax, Qall
+
+
+def _golden_max(func, a, b, xtol=0., integer=False):
+    """
+    Golden-section search of the maximum of func in [a, b]. If integer is True, only
+    integers are evaluated. Returns the best evaluated point and its value.
+    """
+    invphi = (math.sqrt(5.) - 1.) / 2.
+    evals = {}
+
+    def f(x):
+        if integer:
+            x = int(round(x))
+        if x not in evals:
+            evals[x] = func(x)
+        return evals[x]
+
+    if integer:
+        xtol = max(xtol, 2.)
+
+    c = b - invphi * (b - a)
+    d = a + invphi * (b - a)
+    fc, fd = f(c), f(d)
+    while abs(b - a) > xtol:
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - invphi * (b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + invphi * (b - a)
+            fd = f(d)
+
+    if integer:
+        for x in range(int(math.ceil(a)), int(math.floor(b)) + 1):
+            f(x)
+
+    x = max(evals, key=evals.get)
+    return x, evals[x]
+
+
+def pocs_q(ADrec, ADref, normalize=False):
+    """
+    Quality of a reconstruction ADrec with respect to the reference ADref,
+
+        Q = 10 * log( || ADref || ^2 _2  / ||  ADref - ADrec || ^2 _2 ).
+
+    If normalize is True, ADrec is normalized as the stream returned by pocs_recon,
+    each trace to 1 and then the array to 1 (see bowpy.util.base.stream2array).
+
+    :param ADrec: Reconstructed array data
+    :type  ADrec: numpy.ndarray
+
+    :param ADref: Reference array data
+    :type  ADref: numpy.ndarray
+
+    :param normalize: Normalize ADrec
+    :type  normalize: bool
+    """
+    if normalize:
+        norm = abs(ADrec).max(axis=1)
+        norm[norm == 0] = 1.
+        ADrec = ADrec / norm[:, np.newaxis]
+        if ADrec.max() != 0:
+            ADrec = ADrec / ADrec.max()
+
+    return 10.*np.log( np.linalg.norm(ADref,2)**2. / np.linalg.norm(ADref - ADrec,2)**2. )
+
+
+def _pocs_q_task(ArrayData, ADref, noft, alpha, irange, normalize, pocsargs, hidden=None):
+    """
+    Returns Q for every number of iterations in irange, for one alpha. If irange has
+    more than one entry, it is evaluated along one pocs run, see pocs_q_surface.
+    If ADref is None, ArrayData is the reference. If hidden traces are given, they are
+    set to zero and reconstructed, and Q is evaluated for them only, see pocs_cv.
+    """
+    if ADref is None:
+        ADref = ArrayData
+
+    rows = slice(None)
+    if hidden is not None:
+        ArrayData = ArrayData.copy()
+        ArrayData[hidden] = 0.
+        noft = sorted(set(noft) | set(hidden))
+        rows = hidden
+
+    if irange.size == 1:
+        ADrec = pocs(ArrayData, int(irange[0]), noft, alpha, **pocsargs)
+        return [pocs_q(ADrec[rows], ADref[rows], normalize)]
+
+    maxiter = int(irange.max())
+    Qpath = [pocs_q(ArrayData[rows], ADref[rows], normalize)]
+
+    def record(i, datap):
+        Qpath.append(pocs_q(datap[rows], ADref[rows], normalize))
+
+    pocs(ArrayData, maxiter, noft, alpha, callback=record, **pocsargs)
+
+    # A run stopped by tol keeps its last result for all further iterations.
+    Qpath += [Qpath[-1]] * (maxiter + 1 - len(Qpath))
+
+    return [Qpath[int(i)] for i in irange]
+
+
+# Shared input of the processes of pocs_q_surface, set by _pocs_q_init.
+_POCS_Q_SHARED = {}
+
+
+def _pocs_q_init(data, ref, noft, normalize, pocsargs):
+    # One FFT thread per process, the processes already use all cores.
+    fftutil.set_workers(1)
+    shm = [shared_memory.SharedMemory(name=data[0])]
+    _POCS_Q_SHARED.update(ArrayData=np.ndarray(data[1], dtype='float', buffer=shm[0].buf), ADref=None,
+                          noft=noft, normalize=normalize, pocsargs=pocsargs, shm=shm)
+    if ref is not None:
+        shm.append(shared_memory.SharedMemory(name=ref[0]))
+        _POCS_Q_SHARED['ADref'] = np.ndarray(ref[1], dtype='float', buffer=shm[1].buf)
+
+
+def _pocs_q_shared_task(alpha, irange, hidden):
+    sh = _POCS_Q_SHARED
+    return _pocs_q_task(sh['ArrayData'], sh['ADref'], sh['noft'], alpha, irange, sh['normalize'], sh['pocsargs'],
+                        hidden)
+
+
+def _stack_streams(streams, normalize=True):
+    """
+    Returns the data of the streams as an array of shape (events, traces, samples).
+    """
+    data = [stream2array(st.copy(), normalize) for st in streams]
+    if len(set(d.shape for d in data)) > 1:
+        raise IOError('All streams must have the same number of traces and samples')
+
+    return np.array(data)
+
+
+def _pocs_noft(st, dmethod):
+    """
+    Returns the indices of the traces pocs works on, the zero traces of st for
+    dmethod 'reconstruct', all traces for 'denoise'.
+    """
+    if dmethod in ('reconstruct'):
+        recon_list 	= []
+        for i, trace in enumerate(st):
+            try:
+                if trace.stats.zerotrace in ['True']:
+                    recon_list.append(i)
+
+            except AttributeError:
+                if sum(trace.data) == 0. :
+                    recon_list.append(i)
+
+            except:
+                continue
+
+        return recon_list
+
+    elif dmethod in ('denoise', 'de-noise'):
+        return range(len(st))
+
+
+def _fk_extract_polygon(data, polygon, xlabel=None, xticks=None, ylabel=None, yticks=None, eval_mean=1, fs=25):
+    """
+    Only use with the function fk_filter!
+    Function to test the fk workflow with synthetic data
+    param data:	half spectrum of the array data, rfft along the time axis
+    type data:	numpy.ndarray
+    """
+    data_fk, M = _fk_polygon_mask(data, polygon, xlabel, xticks, ylabel, yticks, eval_mean, fs)
+
+    return data_fk * M
 
 
 def _fk_eliminate_polygon(data, polygon, xlabel=None, xticks=None, ylabel=None, yticks=None, eval_mean=1, fs=25):
     """
     Only use with the function fk_filter!
     Function to test the fk workflow with synthetic data
-    param data:	data of the array
+    param data:	half spectrum of the array data, rfft along the time axis
     type data:	numpy.ndarray
     """
-    # Shift 0|0 f-k to center, for easier handling
-    dsfk = np.fft.fftshift(data.conj().transpose())
-    dsfk_tmp = dsfk[0:dsfk.shape[0]/2]
+    data_fk, M = _fk_polygon_mask(data, polygon, xlabel, xticks, ylabel, yticks, eval_mean, fs)
 
-    # Define polygon by user-input.
-    # If eval_mean is true, select area where to calculate the mean value
-    if eval_mean != 1:
-        indicies_eval 				= get_polygon(abs(dsfk_tmp), 4, xlabel, xticks, ylabel, yticks)
-        dsfk_eval 					= dsfk
-        dsfk_eval.conj().transpose().flat[ indicies_eval ] = dsfk_eval.conj().transpose().flat[ indicies_eval ] / float(eval_mean)
-        dsfk_tmp 					= dsfk_eval.copy()
+    return data_fk * (1. - M)
+
+
+def _fk_polygon_mask(data, polygon, xlabel=None, xticks=None, ylabel=None, yticks=None, eval_mean=1, fs=25):
+    """
+    Only use with the function fk_filter!
+    Shows the half spectrum data with k=0 in the center and f decreasing from the
+    Nyquist frequency to 0 along the y-axis, to pick a polygon in it.
+    Returns the (eval_mean corrected) half spectrum and a 0/1 mask of the same shape,
+    which is 1 inside the polygon. Both are in the layout of data, so the mask can be
+    applied directly, no rebuild of the negative frequencies is needed.
 
-    #indicies = get_polygon(np.log(abs(dsfk)), polygon, xlabel, xticks, ylabel, yticks)
-    indicies = get_polygon(abs(dsfk_tmp), polygon, xlabel, xticks, ylabel, yticks, fs)
+    param data:	half spectrum of the array data, rfft along the time axis
+    type data:	numpy.ndarray
+    """
+    iK = data.shape[0]
 
-    # Create new array, only contains extractet energy, pointed to with indicies
-    dsfk_elim 										= np.ones(dsfk_tmp.shape)
-    dsfk_elim.conj().transpose().flat[ indicies ] 	= 0.
-    dsfk_tmp = dsfk_tmp * dsfk_elim
-    data_fk = np.zeros(dsfk.shape).astype('complex')
+    # Row of data shown in column c of the display, the k axis is mirrored
+    # and shifted, so that 0|0 f-k is in the bottom center.
+    kidx = (iK//2 - np.arange(iK)) % iK
+    data_fk = data.copy()
+    dsfk = data_fk[kidx][:, ::-1].transpose()
 
-    #top half of domain.
-    data_fk[0:dsfk.shape[0]/2] 	= dsfk_tmp
+    # Define polygon by user-input.
+    # If eval_mean is true, select area where to calculate the mean value
+    if eval_mean != 1:
+        indicies_eval 			= get_polygon(abs(dsfk), 4, xlabel, xticks, ylabel, yticks)
+        dsfk.transpose().flat[ indicies_eval ] 	= dsfk.transpose().flat[ indicies_eval ] / float(eval_mean)
+        data_fk[kidx] 			= dsfk.transpose()[:, ::-1]
 
-    #Bottom half of domain, exploiting symmetry and shift properties.
-    data_fk[dsfk.shape[0]/2:] 		= np.roll(np.roll(np.flipud(np.fliplr(dsfk_tmp)),1).transpose(), 1).transpose()
+    indicies = get_polygon(abs(dsfk), polygon, xlabel, xticks, ylabel, yticks, fs)
 
-    data_fk = np.fft.ifftshift(data_fk.conj().transpose())
+    # Mask in the display layout, 1 inside of the polygon, mapped back to data.
+    dsfk_mask 							= np.zeros(dsfk.shape)
+    dsfk_mask.transpose().flat[ indicies ] 	= 1.
+    M = np.zeros(data.shape)
+    M[kidx] = dsfk_mask.transpose()[:, ::-1]
 
-    return data_fk
+    return data_fk, M
 
 """
 LS FUNCTIONS
 """
-def _fk_ls_filter_extract_phase_sp(ArrayData, y_dist=False, radius=None, maxk=False):
+def _fk_ls_filter_extract_phase_sp(ArrayData, y_dist, shape, nf=None):
     """
     Only use with the function fk_filter!
-    FK-filter using the Lomb-Scargle Periodogram with the scipy library
+    FK-filter using the Lomb-Scargle transformation, see bowpy.util.fkutil.lsfk, for
+    traces at irregular distances. Extracts the wavenumbers given by shape, as line_cut.
     param data:	data of the array
     type data:	numpy.ndarray
 
-    param snes:	slownessvalue of the desired extracted phase
-    type snes:	int
+    param y_dist: distances of the traces
+    type y_dist: numpy.ndarray
+
+    param shape: shape of the filter, see fk_filter
+    type shape: list
     """
-    return
+    fil = line_cut(np.ones((len(ArrayData), 1)), shape)[:, 0].real
+    return _fk_ls_filter(ArrayData, y_dist, fil, nf)
 
-def _fk_ls_filter_eliminate_phase_sp(ArrayData, y_dist=False, radius=None, maxk=False):
+def _fk_ls_filter_eliminate_phase_sp(ArrayData, y_dist, shape, nf=None):
     """
     Only use with the function fk_filter!
-    Function to test the fk workflow with synthetic data
+    FK-filter using the Lomb-Scargle transformation, see bowpy.util.fkutil.lsfk, for
+    traces at irregular distances. Eliminates the wavenumbers given by shape, as line_set_zero.
     param data:	data of the array
     type data:	numpy.ndarray
 
-    param snes:	slownessvalue of the desired extracted phase
-    type snes:	int
-    """
-    # Define freq Array
-    freq = np.zeros((len(ArrayData), len(ArrayData[0]) / 2  + 1)) + 1j
+    param y_dist: distances of the traces
+    type y_dist: numpy.ndarray
 
-    for i in range(len(ArrayData)):
-        freq_new = np.fft.rfftn(ArrayData[i])
-        freq[i] = freq_new
-
-    # Define k Array
-    freqT = freq.conj().transpose()
-    knum = np.zeros( ( len(freqT), len(freqT[0])  /2 +1 ))
-
-    #calc best range
-    N = len(freqT[0])
-    dN = ( max(freqT[0]) - min(freqT[0]) / N )
-
-    f_temp = np.fft.rfftfreq(len(freqT[0]), dN) * 2.* np.pi
-
-    #1. try:
-    #period_range = np.linspace(min_wavelength, max_bound, len(freqT[0]))
-    #2. try:
-    #period_range = np.linspace(f_temp[1], max(f_temp), N)
-    #3. try:
-    period_range = f_temp
-    #period_range = period_range.astype('float')
-    period_range[0] = 1.
-    #after this change the first outputparameter of the periodogram to a
-    #correlation between the signal and a e^0 function ;)
-    period_range = period_range.astype('float')
-
-    for j in range(len(freqT)):
-        k_new = signal.lombscargle(y_dist, abs(freqT[j]), period_range)
-        k_new = ls2ifft_prep(k_new, abs(freqT[j]))
-        knum[j] = k_new
+    param shape: shape of the filter, see fk_filter
+    type shape: list
+    """
+    fil = line_set_zero(np.ones((len(ArrayData), 1)), shape)[:, 0].real
+    return _fk_ls_filter(ArrayData, y_dist, fil, nf)
 
+def _fk_ls_filter(ArrayData, y_dist, fil, nf=None):
+    """
+    Applies the filter fil, over the wavenumbers in the order of numpy.fft.fftfreq, to
+    the Lomb-Scargle amplitudes of the data. On irregular positions the amplitudes of
+    the wavenumbers are not independent, so only the smaller of the passed and the
+    removed part is reconstructed, and the removed part is subtracted from the data.
+    On a regular grid both are equal.
+    """
+    nx, it = ArrayData.shape
+    A, B, k = lsfk(ArrayData, y_dist, nf)
+    fil = fil[0:k.size, np.newaxis]
 
-    #change dtype to integer, for further processing
-    period_range = period_range.astype('int')
-    fkspectra = knum
-    dsfft = line_set_zero(fkspectra, 0, radius)
+    if np.sum(fil) <= np.sum(1. - fil):
+        return ilsfk(fil * A, fil * B, y_dist, it)
 
-    return fkspectra.conj().transpose(), period_range
+    return ArrayData - ilsfk((1. - fil) * A, (1. - fil) * B, y_dist, it)
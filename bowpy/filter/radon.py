@@ -5,9 +5,8 @@ from numpy import dot
 import math
 from math import pi
 
-import scipy as sp
-from scipy import sparse
 from bowpy.util.base import nextpow2
+from bowpy.util import fftutil
 from bowpy.util.picker import get_polygon
 from bowpy.util.array_util import stream2array, attach_epidist2coords, epidist2nparray
 
@@ -26,7 +25,7 @@ from obspy.core.event.event import Event
  GNU General Public License for more details: http://www.gnu.org/licenses/
 """
 
-def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperparameters):
+def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperparameters, fmin=None, fmax=None):
 	"""
 	This function applies the radon_inverse, the user is now able to pick a polygon around the energy 
 	that should be extracted. It returns the dataset containing only the extracted energy.
@@ -44,7 +43,8 @@ def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperp
 	st_input = st.copy()
 	
 	print('Starting inverse Radon-Transformation')
-	R, t, epi = radon_inverse(st_input, inv, event, p, weights, line_model, inversion_model, hyperparameters)
+	R, t, epi = radon_inverse(st_input, inv, event, p, weights, line_model, inversion_model, hyperparameters,
+							  fmin=fmin, fmax=fmax)
 	indicies = get_polygon(R, no_of_vert=8, xlabel=r'$\tau$', ylabel='p')
 	Rpick=np.zeros(R.shape)
 	Rpick.conj().transpose().flat[ indicies ]=1
@@ -59,7 +59,7 @@ def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperp
 	return Mpick, xticks, yticks
 
 
-def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyperparameters):
+def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyperparameters, fmin=None, fmax=None):
 	"""
 	This function inverts move-out data to the Radon domain given the inputs:
 	:param st:
@@ -85,6 +85,13 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 								 'Cauchy'   - Non-linear regularization see Sacchi & Ulrych 1995
 	
 	:param hyperparameters: trades-off between fitting the data and chosen damping.
+
+	:param fmin: Lowest frequency in Hz that is inverted, lower frequencies are set to zero.
+	:param fmax: Highest frequency in Hz that is inverted, higher frequencies are set to zero.
+
+	The frequencies are inverted in blocks, with the steering matrices of a block built at
+	once and its least-squares systems solved in one batched call. If there are fewer traces
+	than slownesses, the equivalent systems of size len(delta) are solved instead of len(p).
 	
 	returns: radon domain is ordered size(R)==[length(p),length(t)], time-axis and distance-axis.
 	
@@ -123,15 +130,13 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 	delta = np.array([ epi.copy() ])
 	ref_dist = np.mean(delta)
 
-	if not weights:
+	if weights is None:
 		weights = np.ones(delta.size)
 
 	t = np.linspace(0,st_tmp[0].stats.delta * st_tmp[0].stats.npts, st_tmp[0].stats.npts)
 	it=t.size
-	print(it)
-	iF=int(math.pow(2,nextpow2(it)+1)) # Double length
+	iF=fftutil.fast_len(2*it) # Double length
 
-   
 	iDelta=delta.size
 	ip=len(p)
 	iw=len(weights)
@@ -148,7 +153,7 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 
 	#Exit if improper hyperparameters are entered.
 	if inversion_model in ["L1", "Cauchy"]:
-		if not len(hyperparameters == 2):
+		if not len(hyperparameters) == 2:
 			print("Improper number of trade-off parameters\n")
 			R=0
 			return(R)
@@ -159,94 +164,152 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 			return(R)
 
 	#Preallocate space in memory.
-	R=np.zeros((ip,it)) 
 	Rfft=np.zeros((ip,iF)) + 0j
-	A=np.zeros((iDelta,ip)) + 0j
-	Tshift=np.zeros((iDelta,ip)) + 0j
-	AtA=np.zeros((ip,ip)) + 0j
-	AtM=np.zeros((ip,1)) + 0j
-	Ident=np.identity(ip)
 
 	#Define some values
-	Dist_array=delta-ref_dist
+	Dist_array=delta[0]-ref_dist
 	dF=1./(t[0]-t[1])
-	Mfft=np.fft.fft(M,iF,1)
-	W=sparse.spdiags(weights.conj().transpose(), 0, iDelta, iDelta).A
-	dCOST=0.
-	COST_curv=0.
-	COST_prev=0.
+	Mfft=fftutil.fft(M,iF,1)
+	w=np.asarray(weights, dtype='float')
 
 	#Populate ray parameter then distance data in time shift matrix.
-	for j in range(iDelta):
-		if line_model == "parabolic":
-			Tshift[j]=p
-		else: #Linear is default
-			Tshift[j]=p
-	
-	for k in range(ip):
-		if line_model == 'parabolic':
-			Tshift[:,k]=(2. * ref_dist * Tshift[:,k] * Dist_array.conj().transpose()) + (Tshift[:,k] * (Dist_array**2).conj().transpose())
-		else: #Linear is default
-			Tshift[:,k]=Tshift[:,k] * Dist_array[0].conj().transpose()
-
-	# Loop through each frequency.
-	for i in range( int(math.floor((iF+1)/2)) ):
-		print('Step %i of %i' % (i, int(math.floor((iF+1)/2))) )
-		# Make time-shift matrix, A.
-		f = ((float(i)/float(iF))*dF)
-		A = np.exp( (0.+1j)*2*pi*f * Tshift )
+	if line_model == 'parabolic':
+		Tshift = np.outer(2. * ref_dist * Dist_array + Dist_array**2, p)
+	else: #Linear is default
+		Tshift = np.outer(Dist_array, p)
+
+	# Frequencies up to Nyquist, restricted to [fmin, fmax].
+	ifreq = np.arange( int(math.floor((iF+1)/2)) )
+	f = (ifreq/float(iF))*dF
+	band = np.ones(ifreq.size, dtype='bool')
+	if fmin is not None:
+		band &= abs(f) >= fmin
+	if fmax is not None:
+		band &= abs(f) <= fmax
+	ifreq = ifreq[band]
+
+	# |A_jk| = 1, so the damping abs(trace(AtA)) * mu is the same for all frequencies.
+	mu = abs(ip * w.sum()) * hyperparameters[0]
+
+	# For evenly spaced slownesses AtA[k,l] only depends on l-k, AtA is a
+	# Hermitian Toeplitz matrix given by its first row.
+	dp = np.diff(p)
+	uniform = ip > 1 and np.ptp(dp) <= 1e-9 * abs(dp[0])
+	toe = np.subtract.outer(np.arange(ip), np.arange(ip))
+
+	# Steering matrices of neighbouring frequencies differ by the factor E.
+	E = np.exp( (0.+1j)*2*pi*(dF/float(iF)) * Tshift )
+
+	# Loop through blocks of frequencies, the steering matrices of a block
+	# take about 32 MB.
+	nblock = max(1, 2**21 // (iDelta*ip))
+	for k in range(0, ifreq.size, nblock):
+		i = ifreq[k:k+nblock]
+
+		# Make time-shift matrices, A, shape (len(i), iDelta, ip).
+		A = np.empty((i.size, iDelta, ip), dtype='complex')
+		A[0] = np.exp( (0.+1j)*2*pi*f[i[0]] * Tshift )
+		A[1:] = E
+		np.cumprod(A, axis=0, out=A)
+		Mi = Mfft[:,i].transpose()
 
 		# M = A R ---> AtM = AtA R
+		AtA = None
+		if ip <= iDelta:
+			if uniform:
+				c = np.matmul((w * A[:,:,0].conj())[:,None,:], A)[:,0,:]
+				AtA = np.where(toe <= 0, c[:,abs(toe)], c[:,abs(toe)].conj())
+			else:
+				AtA = np.matmul(A.conj().swapaxes(-1, -2) * w, A)
+
 		# Solve the weighted, L2 least-squares problem for an initial solution.
-		AtA = dot( dot(A.conj().transpose(), W), A )
-		AtM = dot( A.conj().transpose(), dot( W, Mfft[:,i] ) )
-		mu = abs(np.trace(AtA)) * hyperparameters[0]
-		Rfft[:,i] = sp.linalg.solve((AtA + mu*Ident), AtM)
+		Ri = _radon_solve(A, w, Mi, mu, AtA=AtA)
 
 		#Non-linear methods use IRLS to solve, iterate until convergence to solution.
 		if inversion_model in ("Cauchy", "L1"):
-			
-			#Initialize hyperparameters.
-			b=hyperparameters[1]
-			lam=mu*b
-
-			#Initialize cost functions.
-			dCOST = float("Inf")
-			if inversion_model == "Cauchy":
-				COST_prev = np.linalg.norm( Mfft[:,i] - dot(A,Rfft[:,i]), 2 ) + lam*sum( np.log( abs(Rfft[:,i]**2 + b) ) )
-			elif inversion_model == "L1":
-				COST_prev = np.linalg.norm( Mfft[:,i] - dot(A,Rfft[:,i]), 2 ) + lam*np.linalg.norm( abs(Rfft[:,i]+1), 1 )
-			itercount=1
-			
-			#Iterate until negligible change to cost function.
-			while dCost > 0.001 and itercount < 10:
-				
-				#Setup inverse problem.
-				if inversion_model == "Cauchy":
-					Q = sparse.spdiags( 1./( abs(Rfft[:,i]**2) + b), 0, ip, ip).A
-				elif inversion_model == "L1":
-					Q = sparse.spdiags( 1./( abs(Rfft[:,i]) + b), 0, ip, ip).A
-				Rfft[:,i]=sp.linalg.solve( ( lam * Q + AtA ), AtM )
-				
-				#Determine change to cost function.
-				if inversion_model == "Cauchy":
-					COST_cur = np.linalg.norm( Mfft[:,i]-A*Rfft[:,i], 2 ) + lam*sum( np.log( abs(Rfft[:,i]**2 + b )-np.log(b) ) )
-				elif inversion_model == "L1":
-					COST_cur = np.linalg.norm( Mfft[:,i]-A*Rfft[:,i], 2 ) + lam*np.linalg.norm( abs(Rfft[:,i]+1) + b, 1 )
-				dCOST = 2*abs(COST_cur - COST_prev)/(abs(COST_cur) + abs(COST_prev))
-				COST_prev = COST_cur
-				
-				itercount += 1
+			Ri = _radon_irls(A, w, Mi, Ri, mu, hyperparameters[1], inversion_model, AtA=AtA)
 
-			#Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
-		if i != 0:
-			Rfft[:,iF-i] = Rfft[:,i].conjugate()
+		Rfft[:,i] = Ri.transpose()
 
-	R = np.fft.ifft(Rfft, iF)
+	#Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
+	i = ifreq[ifreq != 0]
+	Rfft[:,iF-i] = Rfft[:,i].conjugate()
+
+	R = fftutil.ifft(Rfft, iF)
 	R = R[:,0:it]
 
 	return R, t, epi
 
+def _radon_solve(A, w, M, mu, q=None, AtA=None):
+	"""
+	Solves (A^H W A + mu Q) R = A^H W M for a stack of steering matrices A, shape
+	(nfreq, ndelta, np), data M, shape (nfreq, ndelta), weights w and the diagonal
+	q of Q, default is the identity. AtA = A^H W A can be passed if known. If
+	ndelta < np the equivalent system R = Q^-1 A^H W (A Q^-1 A^H W + mu I)^-1 M
+	of size ndelta is solved.
+	"""
+	qinv = 1. if q is None else 1./q
+	if A.shape[-1] <= A.shape[-2]:
+		if AtA is None:
+			AtA = np.matmul(A.conj().swapaxes(-1, -2) * w, A)
+		# A^H W M = (M^H W A)^H, without a transposed copy of A.
+		AtM = np.matmul((w * M).conj()[...,None,:], A).conj().swapaxes(-1, -2)
+		lhs = AtA.copy()
+		_diagonal(lhs)[...] += mu * (1. if q is None else q)
+		return np.linalg.solve(lhs, AtM)[...,0]
+
+	Ah = A.conj().swapaxes(-1, -2)
+	AQ = A if q is None else A * qinv[...,None,:]
+	AAt = np.matmul(AQ, Ah) * w
+	_diagonal(AAt)[...] += mu
+	y = np.linalg.solve(AAt, M[...,None])
+	R = np.matmul(Ah, w[:,None] * y)[...,0]
+
+	return qinv * R
+
+def _diagonal(a):
+	"""
+	Writeable view of the diagonals of a C-contiguous stack of square matrices.
+	"""
+	n = a.shape[-1]
+	return a.reshape(a.shape[:-2] + (n*n,))[..., ::n+1]
+
+def _radon_irls(A, w, M, R, mu, b, inversion_model, maxiter=10, tol=1e-3, AtA=None):
+	"""
+	Iteratively reweighted least squares of radon_inverse for the 'L1' and 'Cauchy'
+	models, see Sacchi 1997, for a block of frequencies. Frequencies drop out
+	once the relative change of their cost is below tol.
+	"""
+	lam = mu*b
+
+	def cost(A, M, R):
+		misfit = np.linalg.norm( M - np.matmul(A, R[...,None])[...,0], 2, axis=-1 )
+		if inversion_model == "Cauchy":
+			return misfit + lam*np.sum( np.log( 1. + abs(R)**2 / b ), axis=-1 )
+		return misfit + lam*np.sum( abs(R), axis=-1 )
+
+	R = R.copy()
+	active = np.arange(R.shape[0])
+	COST_prev = cost(A, M, R)
+	for itercount in range(1, maxiter):
+		#Setup inverse problem.
+		if inversion_model == "Cauchy":
+			q = 1./( abs(R[active])**2 + b )
+		else:
+			q = 1./( abs(R[active]) + b )
+		R[active] = _radon_solve(A[active], w, M[active], lam, q,
+								 AtA=None if AtA is None else AtA[active])
+
+		#Determine change to cost function.
+		COST_cur = cost(A[active], M[active], R[active])
+		dCOST = 2*abs(COST_cur - COST_prev[active])/(abs(COST_cur) + abs(COST_prev[active]))
+		COST_prev[active] = COST_cur
+		active = active[dCOST > tol]
+		if active.size == 0:
+			break
+
+	return R
+
 def radon_forward(t,p,R,delta,ref_dist,line_model):
 	"""
 	This function applies the time-shift Radon operator A, to the Radon 
@@ -285,7 +348,7 @@ def radon_forward(t,p,R,delta,ref_dist,line_model):
 		raise TypeError
 
 	it=t.size
-	iF=int(math.pow(2,nextpow2(it)+1)) # Double length
+	iF=fftutil.fast_len(2*it) # Double length
 	iDelta=delta.size
 	ip=len(p)
 
@@ -303,7 +366,7 @@ def radon_forward(t,p,R,delta,ref_dist,line_model):
 	#Define some values.
 	Dist_array=delta-ref_dist
 	dF=1./(t[0]-t[1])
-	Rfft=np.fft.fft(R,iF,1)
+	Rfft=fftutil.fft(R,iF,1)
 
 	#Populate ray parameter then distance data in time shift matrix.
 	for j in range(iDelta):
@@ -332,7 +395,7 @@ def radon_forward(t,p,R,delta,ref_dist,line_model):
 		if i != 0:
 			Mfft[:,iF-i] = Mfft[:,i].conjugate()
 
-	M = np.fft.ifft(Mfft, iF)
+	M = fftutil.ifft(Mfft, iF)
 	M = M[:,0:it]		
 
 	return(M)
@@ -3,316 +3,507 @@ import numpy
 import numpy as np
 from numpy import dot
 import math
-import scipy as sp
-from bowpy.util.fkutil import nextpow2
-from bowpy.util.base import stream2array, array2stream
-import sys
-
-def ssa_denoise_recon(st, p, flow, fhigh):
-	"""
-	SSA method, that de-noises the data given in stream by a rank reduction of the singular values of the
-	Hankel matrix, created from the data in st and the sampling interval of the traces, to p.
-
- 	:param st:     Stream of data
-	:type  st:
-
-	:param dt:     sampling interval
-	:type  dt: 	   float
-
-	:param p:      number of singular values used to reconstuct the data
-	:type  p:	   int
-	
-	:param flow:   min  freq. in the data in Hz
-	:type  flow:   float
-
-	:param fhigh:  max  freq. in the data in Hz
-	:type  fhigh:  float
-
-
-	Example
-	st = stream
-	dt = st[0].stats.delta
-	p = 4
-	flow = 1
-	fhigh = 250
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+import scipy.sparse.linalg
+from bowpy.util import fftutil
+from bowpy.util.base import stream2array, array2stream, patch_tiles
+
+def ssa_denoise_recon(st, p, flow, fhigh, window=None, overlap=0.5, workers=None, tol=1e-3, maxiter=10,
+                      method='svd'):
+    """
+    SSA method, that de-noises the data given in stream by a rank reduction of the singular values of the
+    Hankel matrix, created from the data in st and the sampling interval of the traces, to p.
+
+    :param st:     Stream of data
+    :type  st:     obspy.core.stream.Stream
+
+    :param p:      number of singular values used to reconstuct the data
+    :type  p:      int
+
+    :param flow:   min  freq. in the data in Hz
+    :type  flow:   float
+
+    :param fhigh:  max  freq. in the data in Hz
+    :type  fhigh:  float
+
+    :param window: Length of the time windows in s. If set, the traces are split into
+                   overlapping windows, each window is de-noised on its own, so that its
+                   spectrum is closer to stationary, and the windows are merged by
+                   overlap-add with sin^2 tapers. Default is the whole trace.
+    :type  window: float
+
+    :param overlap: Overlap of neighbouring windows, as part of the window length
+    :type  overlap: float
+
+    :param workers: Number of threads the frequency slices are distributed on
+    :type  workers: int
+
+    :param tol:    Tolerance of the rank reductions, see fx_ssa
+    :type  tol:    float
+
+    :param maxiter: Maximum number of rank reductions per frequency, see fx_ssa
+    :type  maxiter: int
+
+    :param method: 'svd' or 'lanczos', see fx_ssa
+    :type  method: string
 
-	st_ssa = ssa_denoise_recon(st, dt, p, flow, fhigh)
-	"""
-	st_tmp = st.copy()
-	
-	data = stream2array(st_tmp)
-
-	dt = st_tmp[0].stats.delta
-
-	data_ssa = fx_ssa(data,dt,p,flow,fhigh)
-	
-	st_ssa = array2stream(data_ssa, st_tmp)
-	
-	return st_ssa
-
-def ssa(d,nw,p,ssa_flag):
-	"""
-	SSA: 1D Singular Spectrum Analysis for snr enhancement
-
-	  dp,sing,R = ssa(d,nw,p,ssa_flag);
-
-	  IN   d:   1D time series (column)
-	       nw:  view used to make the Hankel matrix
-	       p:   number of singular values used to reconstuct the data
-	       ssa_flag = 0 do not compute R
-
-	  OUT  dp:  predicted (clean) data
-	       R:   matrix consisting of the data predicted with
-	            the first eof (R[:,0]), the second eof (R[:,1]) etc
-	       sing: singular values of the Hankel matrix
-
-	  Example:
-		from math import pi
-		import numpy as np
-		from numpy import cos
-		import matplotlib.pyplot as plt
-		from bowpy.filter.ssa import ssa
-		import scipy.io as sio
-		
-		rand =  sio.loadmat("../../mtz_ssa/randomnumbers.mat")
-		r = rand['r']
-		d = (cos(2*pi*0.01*np.linspace(1,200,200)) + 0.5*r[:,0])
-		dp, sing, R = ssa(d,100,2,0)
-		
-		
-		plt.plot(d/d.max())
-		plt.plot(dp/dp.max()+3)
-		plt.ion()
-		plt.draw()
-		plt.show()
-		plt.ioff()
-
-	  Based on: 
-
-	  M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
-	                    http://www.geoconvention.org/2009abstracts/194.pdf
-
-	  Copyright (C) 2008, Signal Analysis and Imaging Group.
-	  For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
-	  Author: M.D.Sacchi
-	  Translated to Python by: S. Schneider, 2016
-
-
-
-	  This program is free software: you can redistribute it and/or modify
-	  it under the terms of the GNU General Public License as published
-	  by the Free Software Foundation, either version 3 of the License, or
-	  any later version.
-
-	  This program is distributed in the hope that it will be useful,
-	  but WITHOUT ANY WARRANTY; without even the implied warranty of
-	  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-	  GNU General Public License for more details: http://www.gnu.org/licenses/
-
-	"""
-
-
-
-	# Check for Data type of variables.
-	if not type(d) == numpy.ndarray:
-		print( "Wrong input type of d, must be numpy.ndarray" )
-		raise TypeError
-
-	nt = d.size
-	N = int(nt-nw+1)
-	l = np.arange(0,nw,1)
-	R = np.zeros((nt,p))
-
- 	# Make Hankel Matrix.
-	M = np.zeros((N-1,N)).astype('complex')
-	Mp = np.zeros((N-1,N)).astype('complex')
-
-	for k in range(N):
-		M[:,k] = d[k+l]
-
- 	# Eigenimage decomposition
-
-	U,S,V = sp.linalg.svd(M)
-	
-
-
-	# Reconstruct with one oscillatory component at the time.
-	if not ssa_flag == 0:
-	 	for k in range(p):
-			u = np.zeros((N-1,2)).astype('complex')
-	 		u[:,0] = U[:,k]
-	 		Mp = dot( dot(u, u.conj().transpose()), M )
-	 		R[:,k] = average_anti_diag(Mp)
-	 	dp = sum(d)
-
-	else:
-	 	
-		for k in range(p):
-			u = np.zeros((N-1,2)).astype('complex')
-			u[:,0] = U[:,k]
-			Mp = Mp + dot( dot(u, u.conj().transpose()), M )
-
-		R = None
-		dp = average_anti_diag(Mp)
-		
-
-	sing = S
-
-	return(dp,sing,R)
-
-def fx_ssa(data,dt,p,flow,fhigh):
-	"""
-	FX_SSA: Singular Spectrum Analysis in the fx domain for snr enhancement
-	
-	
-	 [data_f] = fx_ssa(data,dt,p,flow,fhigh);
-	
-	  IN   data:      data (traces are columns)
-	       dt:     sampling interval
-	       p:      number of singular values used to reconstuct the data
-	       flow:   min  freq. in the data in Hz
-	       fhigh:  max  freq. in the data in Hz
-	
-	
-	  OUT  data_f:  filtered data
-	
-	  Example:
-	
-	        d = linear_events;
-	        [df] = fx_ssa(d,0.004,4,1,120);
-	        wigb([d,df]);
-	
-	  Based on:
-	
-	  M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
-	                    http://www.geoconvention.org/2009abstracts/194.pdf
-	
-	  Copyright (C) 2008, Signal Analysis and Imaging Group.
-	  For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
-	  Author: M.D.Sacchi
-	  Translated to Python by: S. Schneider 2016
-	
-	  This program is free software: you can redistribute it and/or modify
-	  it under the terms of the GNU General Public License as published
-	  by the Free Software Foundation, either version 3 of the License, or
-	  any later version.
-	
-	  This program is distributed in the hope that it will be useful,
-	  but WITHOUT ANY WARRANTY; without even the implied warranty of
-	  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-	  GNU General Public License for more details: http://www.gnu.org/licenses/
-	
-	"""
-	nt, ntraces = data.shape
-	nf = 2 * 2 ** nextpow2(nt)
-
-	# First and last samples of the DFT.
-
-	ilow = int(math.floor(flow*dt*nf)+1)
-	if ilow < 1:
-		ilow = 1
-
-	ihigh = int(math.floor(fhigh*dt*nf)+1)
-	if ihigh > math.floor(nf/2)+1:
-		ihigh = int(math.floor(nf/2)+1)
-	
-	data_FX = np.fft.fft(data, nf, axis=0)
-	data_FX_f = np.zeros(data_FX.shape).astype('complex')
-	
-	nw = int(math.floor(ntraces/2))
-
-	print("		Loop through frequencies \n")
-	i=1
-	rend = len(range(ilow,ihigh+1))
-	for k in range(ilow,ihigh+1):
-		
-		prcnt = 100*i/rend
-		print("		%i %% done" % (prcnt), end="\r")
-		sys.stdout.flush()
-
-		tmp = data_FX[k-1,:].transpose()
-		
-		for j in range(10):
-			tmp_out = ssa(tmp,nw,p,0)[0]
-			tmp = tmp_out
-
-		data_FX_f[k-1,:] = tmp_out
-		i+=1
-
-	for k in range(nf/2+2, nf):
-		data_FX_f[k-1,:] = data_FX_f[nf-k+1,:].conj()
-		
-	data_f = np.fft.ifft(data_FX_f, axis=0)
-	data_f = data_f[0:nt,:].real
-	
-	return data_f
 
-def average_anti_diag(A):
-	"""
-	Given a Hankel matrix A,  this program retrieves
-	the signal that was used to make the Hankel matrix
-	by averaging along the antidiagonals of A.
+    Example
+    st = stream
+    p = 4
+    flow = 1
+    fhigh = 250
+
+    st_ssa = ssa_denoise_recon(st, p, flow, fhigh, window=20., workers=4)
+    """
+    st_tmp = st.copy()
+
+    data = stream2array(st_tmp)
+
+    dt = st_tmp[0].stats.delta
+
+    # fx_ssa expects the traces as columns.
+    args = (dt, p, flow, fhigh, tol, maxiter, method, workers)
+    if window is None:
+        data_ssa = fx_ssa(data.transpose(), *args).transpose()
+    else:
+        nt = data.shape[1]
+        data_ssa = np.zeros(data.shape)
+        wsum = np.zeros(nt)
+        for t0, t1, w in patch_tiles(nt, int(round(window / dt)), overlap):
+            data_ssa[:,t0:t1] += w * fx_ssa(data[:,t0:t1].transpose(), *args).transpose()
+            wsum[t0:t1] += w
+        data_ssa /= wsum
+
+    st_ssa = array2stream(data_ssa, st_tmp)
+
+    return st_ssa
+
+def ssa(d,nw,p,ssa_flag,method='svd',workers=None):
+    """
+    SSA: 1D Singular Spectrum Analysis for snr enhancement
+
+      dp,sing,R = ssa(d,nw,p,ssa_flag);
+
+      IN   d:   1D time series (column)
+           nw:  view used to make the Hankel matrix
+           p:   number of singular values used to reconstuct the data
+           ssa_flag = 0 do not compute R
+           method: 'svd' decomposes the full Hankel matrix, 'lanczos' computes only
+                   the first p singular triplets with ARPACK, applying the Hankel
+                   matrix as FFT convolutions (see hankel_operator). The Hankel
+                   matrix is never formed and the memory grows linearly with
+                   the length of d.
+           workers: number of threads of the FFTs of method 'lanczos',
+                    see bowpy.util.fftutil
+
+      OUT  dp:  predicted (clean) data
+           R:   matrix consisting of the data predicted with
+                the first eof (R[:,0]), the second eof (R[:,1]) etc
+           sing: singular values of the Hankel matrix, only the first p
+                 for method 'lanczos'
+
+      Example:
+        from math import pi
+        import numpy as np
+        from numpy import cos
+        import matplotlib.pyplot as plt
+        from bowpy.filter.ssa import ssa
+        import scipy.io as sio
 
-	M.D.Sacchi
-	2008
-	SAIG - Physics - UofA
-	msacchi@ualberta.ca
+        rand =  sio.loadmat("../../mtz_ssa/randomnumbers.mat")
+        r = rand['r']
+        d = (cos(2*pi*0.01*np.linspace(1,200,200)) + 0.5*r[:,0])
+        dp, sing, R = ssa(d,100,2,0)
 
 
-	In    A: A hankel matrix
+        plt.plot(d/d.max())
+        plt.plot(dp/dp.max()+3)
+        plt.ion()
+        plt.draw()
+        plt.show()
+        plt.ioff()
 
-	Out   s: signal (column vector)
-	"""
+      Based on:
 
-	"""
-	MATLAB
-	[m,n] = size(A);
-	N = m+n-1;
+      M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
+                        http://www.geoconvention.org/2009abstracts/194.pdf
 
-	 s = zeros(N,1);
+      Copyright (C) 2008, Signal Analysis and Imaging Group.
+      For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
+      Author: M.D.Sacchi
+      Translated to Python by: S. Schneider, 2016
 
-	 for i = 1 : N
 
-	  a = max(1,i-m+1);
-	  b = min(n,i);
 
-	   for k = a : b
-	    s(i,1) = s(i,1) + A(i-k+1,k);
-	   end
+      This program is free software: you can redistribute it and/or modify
+      it under the terms of the GNU General Public License as published
+      by the Free Software Foundation, either version 3 of the License, or
+      any later version.
 
-	 s(i,1) = s(i,1)/(b-a+1);
+      This program is distributed in the hope that it will be useful,
+      but WITHOUT ANY WARRANTY; without even the implied warranty of
+      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+      GNU General Public License for more details: http://www.gnu.org/licenses/
 
-	 end;
- 	"""
+    """
+
+
+
+    # Check for Data type of variables.
+    if not type(d) == numpy.ndarray:
+        print( "Wrong input type of d, must be numpy.ndarray" )
+        raise TypeError
 
- 	m,n = A.shape
+    if method in ('lanczos'):
+        M = hankel_operator(d, nw, workers)
+        if p < min(M.shape):
+            U,S,V = sparse.linalg.svds(M, k=p, v0=np.ones(min(M.shape)))
+            order = np.argsort(S)[::-1]
+            U,S,V = U[:,order], S[order], V[order]
+        else:
+            # ARPACK needs p < min(M.shape), small matrices are decomposed directly.
+            U,S,V = np.linalg.svd(hankel_matrix(d.astype('complex'), nw), full_matrices=False)
+            U,S,V = U[:,:p], S[:p], V[:p]
+        R = average_anti_diag_outer(U * S, V, workers)
+        dp = R.sum(axis=1)
+        if ssa_flag == 0:
+            R = None
+
+        return(dp,S,R)
+
+    # Make Hankel Matrix, M[i,k] = d[i+k].
+    M = hankel_matrix(d.astype('complex'), nw)
+
+    # Eigenimage decomposition
+
+    U,S,V = np.linalg.svd(M, full_matrices=False)
+    Up = U[:,:p]
+
+    # Reconstruct with one oscillatory component at the time.
+    if not ssa_flag == 0:
+        Mk = Up.transpose()[:,:,None] * dot(Up.conj().transpose(), M)[:,None,:]
+        R = average_anti_diag(Mk).transpose()
+        dp = R.sum(axis=1)
+
+    else:
+        Mp = dot(Up, dot(Up.conj().transpose(), M))
+        R = None
+        dp = average_anti_diag(Mp)
+
+    sing = S
+
+    return(dp,sing,R)
+
+def fx_ssa(data,dt,p,flow,fhigh,tol=1e-3,maxiter=10,method='svd',workers=None):
+    """
+    FX_SSA: Singular Spectrum Analysis in the fx domain for snr enhancement
+
+
+     [data_f] = fx_ssa(data,dt,p,flow,fhigh);
+
+      IN   data:      data (traces are columns)
+           dt:     sampling interval
+           p:      number of singular values used to reconstuct the data
+           flow:   min  freq. in the data in Hz
+           fhigh:  max  freq. in the data in Hz
+           tol:    the rank reduction of a frequency slice is repeated until
+                   its relative change is below tol, at most maxiter times
+           maxiter: maximum number of rank reductions per frequency
+           method: 'svd' reduces all frequencies together with batched SVDs,
+                   'lanczos' reduces them one by one without forming the
+                   Hankel matrices, for long profiles (see ssa)
+           workers: number of threads, the frequency slices are split
+                    into blocks that are reduced in parallel
+
+
+      OUT  data_f:  filtered data
+
+      Example:
+
+            d = linear_events;
+            [df] = fx_ssa(d,0.004,4,1,120);
+            wigb([d,df]);
+
+      Based on:
+
+      M.D.Sacchi, 2009, FX SSA, CSEG Annual Convention, Abstracts,392-395.
+                        http://www.geoconvention.org/2009abstracts/194.pdf
+
+      Copyright (C) 2008, Signal Analysis and Imaging Group.
+      For more information: http://www-geo.phys.ualberta.ca/saig/SeismicLab
+      Author: M.D.Sacchi
+      Translated to Python by: S. Schneider 2016
+
+      This program is free software: you can redistribute it and/or modify
+      it under the terms of the GNU General Public License as published
+      by the Free Software Foundation, either version 3 of the License, or
+      any later version.
+
+      This program is distributed in the hope that it will be useful,
+      but WITHOUT ANY WARRANTY; without even the implied warranty of
+      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+      GNU General Public License for more details: http://www.gnu.org/licenses/
+
+    """
+    nt, ntraces = data.shape
+    nf = fftutil.fast_len(2 * nt)
+
+    # First and last samples of the DFT.
+
+    ilow = int(math.floor(flow*dt*nf)+1)
+    if ilow < 1:
+        ilow = 1
+
+    ihigh = int(math.floor(fhigh*dt*nf)+1)
+    if ihigh > math.floor(nf/2)+1:
+        ihigh = int(math.floor(nf/2)+1)
+
+    data_FX = fftutil.rfft(data, nf, axis=0, workers=workers)
+    data_FX_f = np.zeros(data_FX.shape).astype('complex')
+
+    nw = int(math.floor(ntraces/2))
+
+    args = (nw, p, tol, maxiter, method)
+    slices = data_FX[ilow-1:ihigh,:]
+    if not workers or workers == 1:
+        data_FX_f[ilow-1:ihigh,:] = _fx_ssa_slices(slices, *args, workers=workers)
+    else:
+        # Each thread of the pool runs its FFTs single-threaded, as the
+        # pocs_q processes do, to not start workers times the cores.
+        blocks = [block for block in np.array_split(np.arange(slices.shape[0]), workers) if block.size]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda block: _fx_ssa_slices(slices[block], *args, workers=1), blocks)
+            for block, result in zip(blocks, results):
+                data_FX_f[ilow-1+block,:] = result
+
+    data_f = fftutil.irfft(data_FX_f, nf, axis=0, workers=workers)
+    data_f = data_f[0:nt,:]
+
+    return data_f
+
+def _fx_ssa_slices(slices, nw, p, tol, maxiter, method, workers=None):
+    """
+    Rank reduction of the frequency slices of fx_ssa. All slices are reduced
+    together, slices that converged drop out of the following iterations.
+    workers is the number of threads of the FFTs of method 'lanczos'.
+    """
+    tmp = slices.copy()
+    active = np.arange(tmp.shape[0])
+    for j in range(maxiter):
+        if method in ('lanczos'):
+            tmp_out = np.array([ssa(x, nw, p, 0, method='lanczos', workers=workers)[0] for x in tmp[active]])
+        else:
+            tmp_out = ssa_rank_reduce(tmp[active], nw, p)
+        change = np.linalg.norm(tmp_out - tmp[active], axis=1)
+        tmp[active] = tmp_out
+        if tol:
+            active = active[change > tol * np.linalg.norm(tmp_out, axis=1)]
+            if active.size == 0:
+                break
+
+    return tmp
+
+def ssa_rank_reduce(data, nw, p):
+    """
+    Rank reduction of the Hankel matrices of several signals at once, the
+    batched kernel of fx_ssa. Each signal is embedded into its Hankel matrix,
+    which is reduced to rank p by a truncated SVD and averaged back along its
+    anti-diagonals.
+
+    :param data: Signals, one per row
+    :type  data: numpy.ndarray
+
+    :param nw: Number of rows of the Hankel matrices
+    :type  nw: int
+
+    :param p: Number of singular values kept
+    :type  p: int
+
+    returns
+
+    :param data_p: Rank reduced signals
+    :type  data_p: numpy.ndarray
+    """
+    M = hankel_matrix(data, nw)
+    U, S, Vh = truncated_svd(M, p)
+    Mp = np.matmul(U * S[...,None,:], Vh)
+
+    return average_anti_diag(Mp)
+
+def hankel_matrix(d, nw):
+    """
+    Returns the Hankel matrices M[...,i,k] = d[...,i+k] of the signals in the last
+    axis of d with nw rows, as a read-only strided view without copying.
+
+    :param d: Signal(s)
+    :type  d: numpy.ndarray
+
+    :param nw: Number of rows
+    :type  nw: int
+    """
+    return np.lib.stride_tricks.sliding_window_view(d, d.shape[-1] - nw + 1, axis=-1)
+
+def hankel_operator(d, nw, workers=None):
+    """
+    Returns the Hankel matrix M[i,k] = d[i+k] of the signal d with nw rows as a
+    scipy.sparse.linalg.LinearOperator. Products with M and its adjoint are
+    evaluated as correlations with d via FFTs, in O(n log n) time and O(n) memory.
+
+    :param d: Signal
+    :type  d: numpy.ndarray
+
+    :param nw: Number of rows
+    :type  nw: int
+
+    :param workers: Number of threads of the FFTs, see bowpy.util.fftutil
+    :type  workers: int
+    """
+    d = np.asarray(d, dtype='complex')
+    nt = d.size
+    N = nt - nw + 1
+    L = fftutil.fast_len(nt + max(nw, N) - 1)
+    D = fftutil.fft(d, L, workers=workers)
+    Dc = fftutil.fft(d.conj(), L, workers=workers)
+
+    def matvec(v):
+        # (M v)[i] = sum_k d[i+k] v[k] = (d * v[::-1])[i+N-1]
+        v = np.ravel(v)
+        return fftutil.ifft(D * fftutil.fft(v[::-1], L, workers=workers), L, workers=workers)[N-1:N-1+nw]
+
+    def rmatvec(u):
+        # (M^H u)[k] = sum_i conj(d[i+k]) u[i] = (conj(d) * u[::-1])[k+nw-1]
+        u = np.ravel(u)
+        return fftutil.ifft(Dc * fftutil.fft(u[::-1], L, workers=workers), L, workers=workers)[nw-1:nw-1+N]
+
+    return sparse.linalg.LinearOperator((nw, N), matvec=matvec, rmatvec=rmatvec,
+                                        dtype='complex')
+
+def truncated_svd(M, p, oversample=8, power=2):
+    """
+    Truncated SVD of a matrix or a stack of matrices, keeping the p largest singular
+    triplets. If p + oversample is small against the matrix size the randomized range
+    finder of Halko, Martinsson and Tropp (2011) with power iterations is used,
+    otherwise the exact SVD is truncated.
+
+    :param M: Matrix, or stack of matrices in the last two axes
+    :type  M: numpy.ndarray
+
+    :param p: Number of singular triplets
+    :type  p: int
+
+    :param oversample: Additional samples of the range finder
+    :type  oversample: int
+
+    :param power: Number of power iterations
+    :type  power: int
+
+    returns
+
+    :param U: Left singular vectors, shape (..., m, p)
+    :param S: Singular values, shape (..., p)
+    :param Vh: Right singular vectors, shape (..., p, n)
+    """
+    m, n = M.shape[-2:]
+    k = p + oversample
+    if 4 * k >= min(m, n):
+        U, S, Vh = np.linalg.svd(M, full_matrices=False)
+        return U[...,:p], S[...,:p], Vh[...,:p,:]
+
+    Mh = M.conj().swapaxes(-1, -2)
+    omega = np.random.default_rng(0).standard_normal((n, k))
+    Q = np.linalg.qr(np.matmul(M, omega))[0]
+    for i in range(power):
+        Q = np.linalg.qr(np.matmul(Mh, Q))[0]
+        Q = np.linalg.qr(np.matmul(M, Q))[0]
+
+    Ub, S, Vh = np.linalg.svd(np.matmul(Q.conj().swapaxes(-1, -2), M), full_matrices=False)
+
+    return np.matmul(Q, Ub[...,:p]), S[...,:p], Vh[...,:p,:]
+
+def average_anti_diag_outer(U, V, workers=None):
+    """
+    Anti-diagonal averages of the rank-one matrices U[:,j] V[j,:], without forming
+    them. The anti-diagonal sums of an outer product are the convolution of its
+    factors, evaluated for all j at once via FFTs.
+
+    :param U: Left factors, shape (m, p)
+    :type  U: numpy.ndarray
+
+    :param V: Right factors, shape (p, n)
+    :type  V: numpy.ndarray
+
+    :param workers: Number of threads of the FFTs, see bowpy.util.fftutil
+    :type  workers: int
+
+    returns
+
+    :param R: Averaged signals, shape (m+n-1, p)
+    :type  R: numpy.ndarray
+    """
+    m, n = U.shape[0], V.shape[1]
+    N = m+n-1
+    L = fftutil.fast_len(N)
+    R = fftutil.ifft(fftutil.fft(U, L, axis=0, workers=workers)
+                     * fftutil.fft(V.transpose(), L, axis=0, workers=workers),
+                     L, axis=0, workers=workers)[:N]
+    count = np.minimum(np.minimum(np.arange(1, N+1), np.arange(N, 0, -1)), min(m, n))
+
+    return R / count[:,None]
+
+def average_anti_diag(A):
+    """
+    Given a Hankel matrix A,  this program retrieves
+    the signal that was used to make the Hankel matrix
+    by averaging along the antidiagonals of A.
 
- 	N = m+n-1
+    M.D.Sacchi
+    2008
+    SAIG - Physics - UofA
+    msacchi@ualberta.ca
 
- 	s = np.zeros(N).astype('complex')
 
- 	for i in range(N):
-		a = max(1,(i+1)-m+1)
-		b = min(n,(i+1))
-		
-		if a == b:
-			k = a
-			s[i] = s[i] + A[i-k+1,k-1]
-		else:
-	 		for k in range(a,b+1):
-	 			s[i] = s[i] + A[i-k+1,k-1]
+    In    A: A hankel matrix
 
-		s[i]= s[i]/(b-a+1)
- 		
-	return(s)
+    Out   s: signal (column vector)
+    """
 
+    """
+    MATLAB
+    [m,n] = size(A);
+    N = m+n-1;
 
+     s = zeros(N,1);
 
+     for i = 1 : N
 
+      a = max(1,i-m+1);
+      b = min(n,i);
 
+       for k = a : b
+        s(i,1) = s(i,1) + A(i-k+1,k);
+       end
 
+     s(i,1) = s(i,1)/(b-a+1);
 
+     end;
+    """
 
+    m,n = A.shape[-2:]
 
+    # Sum each anti-diagonal i+k of all matrices in one bincount pass and
+    # divide by its length.
+    N = m+n-1
+    lead = A.shape[:-2]
+    nb = int(np.prod(lead))
+    idx = (np.add.outer(np.arange(m), np.arange(n)).ravel()[None,:]
+           + N * np.arange(nb)[:,None]).ravel()
+    count = np.minimum(np.minimum(np.arange(1, N+1), np.arange(N, 0, -1)), min(m, n))
 
+    s = np.bincount(idx, weights=A.real.ravel(), minlength=nb*N)
+    if np.iscomplexobj(A):
+        s = s + 1j * np.bincount(idx, weights=A.imag.ravel(), minlength=nb*N)
+    s = s.reshape(lead + (N,)) / count
 
+    return(s)
@@ -20,6 +20,7 @@ from obspy.taup import TauPyModel
 from obspy.taup.taup_geo import add_geo_to_arrivals
 
 from bowpy.util.base import nextpow2, stream2array, array2stream, array2trace
+from bowpy.util import fftutil
 
 """
 Collection of useful functions for processing seismological array data
@@ -690,6 +691,96 @@ def gaps_fill_zeros(stream, inv, event, decimal_res=1):
     return equi_stream
 
 
+def gaps_fill_grid(stream, inv, spacing=None):
+    """
+    2D version of gaps_fill_zeros for arrays of stations on a grid. The station
+    coordinates, taken from the inventory by get_coords, are projected to
+    x = (longitude - lon0) * cos(lat0) and y = latitude - lat0 in degrees, around
+    the mean position of the stations. Each trace is placed in the nearest cell of a
+    regular grid, with the spacing in degrees, the cells without station are filled
+    with zero-padded Traces. If several stations fall in one cell, the one closest to
+    its center is kept.
+
+    :param stream: Obspy Stream
+
+    :param inv: Obspy Inventory
+
+    :param spacing: Spacing of the grid in degrees, default is the median distance of
+                    the stations to their nearest neighbour
+    :type  spacing: float
+
+    :returns: grid_stream, the traces of the grid cells in row-major order of
+              (y, x), with the coordinates of the cells in stats.coordinates,
+              and shape, the number of cells (ny, nx)
+    """
+    coords = get_coords(inv, returntype="dict")
+    st_tmp = stream.copy()
+
+    try:
+        lat = np.array([coords[".".join(tr.id.split(".")[:2])]["latitude"] for tr in st_tmp])
+        lon = np.array([coords[".".join(tr.id.split(".")[:2])]["longitude"] for tr in st_tmp])
+    except KeyError:
+        msg = "Need the coordinates of all stations in stream, not found in inventory"
+        raise TypeError(msg)
+
+    lat0 = lat.mean()
+    lon0 = lon.mean()
+    coslat0 = math.cos(math.radians(lat0))
+    x = (lon - lon0) * coslat0
+    y = lat - lat0
+
+    fit = spacing is None
+    if fit:
+        dist = np.hypot(x[:, np.newaxis] - x, y[:, np.newaxis] - y)
+        np.fill_diagonal(dist, np.inf)
+        spacing = np.median(dist.min(axis=1))
+    spacing = float(spacing)
+
+    # The grid is shifted to the mean phase of the stations, so small deviations
+    # from the grid do not move them to the next cell. The estimated spacing
+    # is refined by a fit of the positions to their cells.
+    for n in range(4 if fit else 1):
+        if n > 0:
+            idx = np.append(ix - ix.mean(), iy - iy.mean())
+            pos = np.append(x - x.mean(), y - y.mean())
+            if idx.dot(idx) > 0:
+                spacing = idx.dot(pos) / idx.dot(idx)
+        xg = spacing / (2. * np.pi) * np.angle(np.exp(2j * np.pi * x / spacing).mean())
+        yg = spacing / (2. * np.pi) * np.angle(np.exp(2j * np.pi * y / spacing).mean())
+        ix = np.round((x - xg) / spacing).astype('int')
+        iy = np.round((y - yg) / spacing).astype('int')
+
+    xg = xg + ix.min() * spacing
+    yg = yg + iy.min() * spacing
+    ix = ix - ix.min()
+    iy = iy - iy.min()
+    shape = (iy.max() + 1, ix.max() + 1)
+    offset = np.hypot(x - xg - ix * spacing, y - yg - iy * spacing)
+
+    # Keep the station closest to the center of each cell.
+    cells = {}
+    for i in np.argsort(offset):
+        cells.setdefault((iy[i], ix[i]), i)
+
+    traces = []
+    for j in range(shape[0]):
+        for k in range(shape[1]):
+            if (j, k) in cells:
+                newtrace = st_tmp[cells[(j, k)]]
+            else:
+                newtrace = Trace(np.zeros(st_tmp[0].stats.npts))
+                newtrace.stats.delta = st_tmp[0].stats.delta
+                newtrace.stats.starttime = st_tmp[0].stats.starttime
+                newtrace.stats.zerotrace = "True"
+
+            newtrace.stats.coordinates = AttribDict()
+            newtrace.stats.coordinates.latitude = lat0 + yg + j * spacing
+            newtrace.stats.coordinates.longitude = lon0 + (xg + k * spacing) / coslat0
+            traces.append(newtrace)
+
+    return Stream(traces), shape
+
+
 def geometrical_center(inventory):
     lats, lngs, hgt = __coordinate_values(inventory)
 
@@ -1578,8 +1669,8 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
         shift_trace = np.roll(trace, shift_value)
     if method in ("FFT", "fft", "Fft", "fFt", "ffT", "FfT"):
         it = trace.size
-        iF = int(math.pow(2, nextpow2(it)))
-        dft = np.fft.fft(trace, iF)
+        iF = fftutil.fast_len(it)
+        dft = fftutil.fft(trace, iF)
 
         arg = -2. * np.pi * shift_value / float(iF)
         dft_shift = np.zeros(dft.size).astype('complex')
@@ -1587,7 +1678,7 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
         for i, ampl in enumerate(dft):
             dft_shift[i] = ampl * np.complex(np.cos(i * arg), np.sin(i * arg))
 
-        shift_trace = np.fft.ifft(dft_shift, iF)
+        shift_trace = fftutil.ifft(dft_shift, iF)
         shift_trace = shift_trace[0:it].real
 
     return shift_trace, shift_value
@@ -1763,8 +1854,8 @@ def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
     uN = int((slomax - slomin) / slostep + 1)
     urange = np.linspace(slomin, slomax, uN)
     it = data.shape[1]
-    iF = int(math.pow(2, nextpow2(it)))
-    dft = np.fft.fft(data, iF, axis=1)
+    iF = fftutil.fast_len(it)
+    dft = fftutil.fft(data, iF, axis=1)
     vespa = np.zeros((uN, data.shape[1]))
     taxis = np.arange(data.shape[1]) * dsample
 
@@ -1795,7 +1886,7 @@ def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
             dftshift = np.zeros(dft.shape).astype('complex')
             dftshift = dft * shifttable
 
-            shiftdata = np.fft.ifft(dftshift, iF)
+            shiftdata = fftutil.ifft(dftshift, iF)
             vespatrace = shiftdata.real.copy()
 
             # Put it in the right size again.
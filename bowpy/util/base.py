@@ -333,6 +333,43 @@ def nextpow2(i):
     return count
 
 
+def patch_tiles(n, length, overlap):
+    """
+    Returns the patches (start, stop, weights) along an axis of size n. The
+    weights rise and fall as sin^2 across the overlaps with the neighbours,
+    and are 1 elsewhere, also at the borders of the axis.
+
+    :param n: Size of the axis
+    :type  n: int
+
+    :param length: Length of a patch
+    :type  length: int
+
+    :param overlap: Overlap of neighbouring patches, as part of the patch length
+    :type  overlap: float
+    """
+    length = int(min(max(length, 1), n))
+    ramp = int(round(overlap * length))
+    step = max(1, length - ramp)
+
+    starts = list(range(0, n - length + 1, step))
+    if starts[-1] + length < n:
+        starts.append(n - length)
+
+    tiles = []
+    for start in starts:
+        w = np.ones(length)
+        if ramp > 0:
+            rise = np.sin(0.5 * np.pi * (np.arange(ramp) + 0.5) / ramp)**2.
+            if start > 0:
+                w[:ramp] = rise
+            if start + length < n:
+                w[length-ramp:] = rise[::-1]
+        tiles.append((start, start + length, w))
+
+    return tiles
+
+
 def read_file(stream, inventory, catalog, array=False):
     """
     function to read data files, such as MSEED, station-xml and quakeml, in a
@@ -466,10 +503,26 @@ def LCM(a, b):
     return abs(a * b) / fractions.gcd(a, b) if a and b else 0
 
 
+def ksymmetric(fil):
+    """
+    Symmetrizes a filter along the wavenumber axis, so that fil(k) = fil(-k).
+    Only a k-symmetric filter can be applied to the half spectrum (rfft along
+    the time axis) of real data. For real data this gives the same result as
+    applying fil to the full spectrum and taking the real part of the iFFT.
+
+    :param fil: Filter along the wavenumber axis, in FFT order
+    :type  fil: numpy.ndarray
+    """
+    return (fil + np.roll(fil[::-1], 1)) / 2.
+
+
 def line_cut(array, shape):
     """
     Sets the array to zero, except for the 0 line and given features given in shape, acts as bandpass filter.
     "Cuts" one line out + given shape. For detailed information look in bowpy.filter.fk.fk_filter
+    The filter only acts along the wavenumber axis (axis 0), so array can be the full
+    f-k spectrum or its half spectrum, as returned by bowpy.util.fkutil.fktrafo.
+    Further axes, e.g. a stack of events of shape (k, events, f), are filtered alike.
 
     :param array: array-like
     :type  array: numpy.ndarray
@@ -496,18 +549,18 @@ def line_cut(array, shape):
         return new_array
 
     elif name in ['butterworth', 'Butterworth', 'taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
 
     elif name in ['taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
 
     fil_rh = np.flipud(fil_lh)[::-1][0:][::-1]
     fil = np.zeros(2*fil_lh.size)
-    fil[:fil.size/2] = fil_lh
-    fil[fil.size/2:] = fil_rh
+    fil[:fil.size//2] = fil_lh
+    fil[fil.size//2:] = fil_rh
+    fil = ksymmetric(fil)
 
-    new_array = array.transpose() * fil
-    new_array = new_array.transpose()
+    new_array = array * fil.reshape((-1,) + (1,) * (array.ndim - 1))
 
     return(new_array)
 
@@ -516,6 +569,9 @@ def line_set_zero(array, shape):
     """
     Sets line zero in array + features given in shape, acts as bandstop filter.
     For detailed information look in bowpy.filter.fk.fk_filter
+    The filter only acts along the wavenumber axis (axis 0), so array can be the full
+    f-k spectrum or its half spectrum, as returned by bowpy.util.fkutil.fktrafo.
+    Further axes, e.g. a stack of events of shape (k, events, f), are filtered alike.
 
     :param array: array-like
     :type  array: numpy.ndarray
@@ -532,33 +588,32 @@ def line_set_zero(array, shape):
     new_array = array
 
     if name in ['spike', 'Spike']:
-        new_array[0] = np.zeros(array[0].size)
+        new_array[0] = 0.
         return new_array
 
     elif name in ['boxcar', 'Boxcar'] and isinstance(length, int):
-        new_array[0] = np.zeros(array[0].size)
+        new_array[0] = 0.
         newrange = np.linspace(1, length, length).astype('int')
         for i in newrange:
-            new_array[i] = np.zeros(array[new_array.shape[0]-i].size)
-            new_array[new_array.shape[0]-i] = np.zeros(array[new_array.shape[0]-i].size)
+            new_array[i] = 0.
+            new_array[new_array.shape[0]-i] = 0.
         return new_array
 
     elif name in ['butterworth', 'Butterworth', 'taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
 
     elif name in ['taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
         # fil_lh = -1. * fil_lh + 1.
 
     fil_rh = np.flipud(fil_lh)[::-1][1:][::-1]
     fil = np.zeros(2*fil_lh.size)
-    fil[:fil.size/2] = fil_lh
-    fil[fil.size/2+1:] = fil_rh
+    fil[:fil.size//2] = fil_lh
+    fil[fil.size//2+1:] = fil_rh
     newfil = np.ones(fil.shape)
-    newfil = newfil - fil
+    newfil = ksymmetric(newfil - fil)
 
-    new_array = array.transpose() * newfil
-    new_array = new_array.transpose()
+    new_array = array * newfil.reshape((-1,) + (1,) * (array.ndim - 1))
     return(new_array)
 
 
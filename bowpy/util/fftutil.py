@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from bowpy.util.base import nextpow2
+
+try:
+    import scipy.fft as _fftlib
+    from scipy.fft import next_fast_len
+except ImportError:
+    _fftlib = np.fft
+    next_fast_len = None
+
+
+"""
+Central FFT layer of bowpy. All f-k, f-x and shift routines get their padded
+lengths and transforms from here.
+
+The padded lengths are the next even 5-smooth numbers (2^a 3^b 5^c), instead of
+the next power of 2, e.g. 1025 samples are padded to 1080, not 2048. The
+transforms use scipy.fft, running on 'workers' threads. Without scipy.fft,
+numpy.fft and powers of 2 are used, as before.
+"""
+
+# Default number of threads for every transform, -1 uses all cores.
+WORKERS = -1
+
+
+def set_workers(workers):
+    """
+    Sets the default number of threads used by the transforms of this module.
+
+    :param workers: Number of threads, -1 uses all cores
+    :type  workers: int
+    """
+    global WORKERS
+    WORKERS = int(workers)
+
+
+@lru_cache(maxsize=None)
+def fast_len(n):
+    """
+    Returns the padded length of an FFT for n points, the smallest even 5-smooth
+    number >= n. Even lengths keep the Nyquist frequency on its own bin, as the
+    f-k filters expect. The results are cached.
+
+    :param n: Number of points
+    :type  n: int
+    """
+    n = int(n)
+    if n < 2:
+        return 2
+    if next_fast_len is None:
+        return int(math.pow(2, nextpow2(n)))
+
+    return 2 * next_fast_len((n + 1) // 2, real=True)
+
+
+@lru_cache(maxsize=None)
+def fast_shape(shape):
+    """
+    Returns the padded shape of an FFT of an array with the given shape, the
+    fast_len of each axis. The results are cached per shape.
+
+    :param shape: Shape of the array
+    :type  shape: tuple
+    """
+    return tuple(fast_len(n) for n in shape)
+
+
+def _kwargs(workers):
+    if _fftlib is np.fft:
+        return {}
+    if workers is None:
+        workers = WORKERS
+    return {'workers': workers}
+
+
+# Same signatures as numpy.fft, with the number of threads as extra argument.
+def fft(a, n=None, axis=-1, workers=None):
+    return _fftlib.fft(a, n, axis, **_kwargs(workers))
+
+
+def ifft(a, n=None, axis=-1, workers=None):
+    return _fftlib.ifft(a, n, axis, **_kwargs(workers))
+
+
+def rfft(a, n=None, axis=-1, workers=None):
+    return _fftlib.rfft(a, n, axis, **_kwargs(workers))
+
+
+def irfft(a, n=None, axis=-1, workers=None):
+    return _fftlib.irfft(a, n, axis, **_kwargs(workers))
+
+
+def fft2(a, s=None, axes=(-2, -1), workers=None):
+    return _fftlib.fft2(a, s, axes, **_kwargs(workers))
+
+
+def ifft2(a, s=None, axes=(-2, -1), workers=None):
+    return _fftlib.ifft2(a, s, axes, **_kwargs(workers))
+
+
+def rfft2(a, s=None, axes=(-2, -1), workers=None):
+    return _fftlib.rfft2(a, s, axes, **_kwargs(workers))
+
+
+def irfft2(a, s=None, axes=(-2, -1), workers=None):
+    return _fftlib.irfft2(a, s, axes, **_kwargs(workers))
+
+
+def rfftn(a, s=None, axes=None, workers=None):
+    return _fftlib.rfftn(a, s, axes, **_kwargs(workers))
+
+
+def irfftn(a, s=None, axes=None, workers=None):
+    return _fftlib.irfftn(a, s, axes, **_kwargs(workers))
@@ -10,12 +10,17 @@ import obspy.signal.filter as obsfilter
 from obspy.taup import TauPyModel
 from obspy.core.event.event import Event
 from obspy import Stream, Trace, Inventory
-from bowpy.util.base import nextpow2, stream2array
+from bowpy.util.base import nextpow2, stream2array, create_filter, patch_tiles
+from bowpy.util import fftutil
 from bowpy.util.array_util import (attach_coordinates_to_traces,
                                    attach_network_to_traces)
 from bowpy.util.picker import pick_data
 from bowpy.filter.ssa import fx_ssa
 import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from functools import lru_cache, reduce
+from itertools import product
 import scipy as sp
 from scipy import sparse
 
@@ -45,73 +50,76 @@ def convert_lsindex(ls_range, samplespacing):
     return(fft_range)
 
 
-def cg_solver(A, b, x0=None, niter=10):
+def cg_solver(A, b, x0=None, niter=10, tol=None, precond=None, callback=None):
     """
     Conjugate gradient solver for Ax = b lstsqs problems, as shown in
     Tomographic inversion via the conjugate gradient method, Scales, J. 1987
-    Expect a mxn Matrix A, a rhs b and an optional startvalue x0
+    Expect a hermitian, positive definite NxN Matrix A, a rhs b and an optional startvalue x0.
+    A is only used by its products with vectors, it can be an array, a sparse matrix or a
+    scipy.sparse.linalg.LinearOperator.
+
+    :param A: Matrix or operator
+    :type A: numpy.ndarray, scipy.sparse matrix or scipy.sparse.linalg.LinearOperator
+
+    :param b: Right hand side
+    :type b: numpy.ndarray
 
-    :param A:
-    :type A:
+    :param x0: Start value, default is 0
+    :type x0: numpy.ndarray
 
-    :param dv:
-    :type dv:
+    :param niter: Maximum number of iterations
+    :type niter: int
 
-    :param x0:
-    :type x0:
+    :param tol: The iteration stops if ||b - Ax|| <= tol ||b||
+    :type tol: float
 
-    :param niter:
-    :type niter:
+    :param precond: Diagonal of the preconditioner, an approximation of the inverse
+                    of the diagonal of A
+    :type precond: numpy.ndarray
+
+    :param callback: Function called after each iteration as callback(k, x, rnorm)
+    :type callback: function
 
     returns
 
-    :param:
-    :type:
+    :param x: Solution
+    :type x: numpy.ndarray
     """
-
+    A = sparse.linalg.aslinearoperator(A)
     if A.shape[0] != A.shape[1]:
         msg = 'Dimension missmatch, A should be NxN'
         raise IOError(msg)
-    print("--- Using CG-method --- \n \nInitiating matrices... \n \n")
 
-    if x0.any():
-        x = x0
+    if x0 is not None and np.any(x0):
+        x = np.array(x0, dtype=np.result_type(x0, b, A.dtype))
+        r = b - A.matvec(x)
     else:
-        x = np.zeros(A.shape[1])
-
-    r = b - A.dot(x).real
-    p = r.copy()
-
-    print("Starting iterations. \n \n")
-
-    cont = True
-    k = 1
-    while cont:
-        alpha = np.dot(r, r) / np.dot(p, A.dot(p))
-        x_new = x + alpha * p
-        r_new = r - alpha * A.dot(p)
-
-        beta = np.dot(r_new, r_new) / np.dot(r, r)
-        p_new = r_new + beta * p
-
-        x = x_new.copy()
-        p = p_new.copy()
-
-        # mcalc = A.dot(x).real - b
-        # resnorm_old = resnorm
-        # resnorm = np.linalg.norm(mcalc.transpose().toarray(), 2)
+        x = np.zeros(A.shape[1], dtype=np.result_type(b, A.dtype))
+        r = np.array(b, dtype=x.dtype)
+
+    bnorm = np.linalg.norm(b)
+    z = r if precond is None else precond * r
+    p = z.copy()
+    rz = np.vdot(r, z).real
+
+    for k in range(niter):
+        q = A.matvec(p)
+        alpha = rz / np.vdot(p, q).real
+        x += alpha * p
+        r -= alpha * q
+
+        rnorm = np.linalg.norm(r)
+        if callback:
+            callback(k, x, rnorm)
+        if tol and rnorm <= tol * bnorm:
+            break
+
+        z = r if precond is None else precond * r
+        rz_new = np.vdot(r, z).real
+        p = z + (rz_new / rz) * p
+        rz = rz_new
 
-        # print("Misfit after %i iterations is : %f \n" % (int(k+1), resnorm) )
-        if k == niter:
-            cont = False
-        # if resnorm < 1e-8: cont=False
-        # elif abs(resnorm - resnorm_old) < 1e-8: cont=False
-        k += 1
-
-    # solnorm = np.linalg.norm(x.toarray(), 2)
-
-    # return x_new, resnorm, solnorm
-    return x_new
+    return x
 
 
 def create_iFFT2mtx(nx, ny):
@@ -174,7 +182,76 @@ def create_iFFT2mtx(nx, ny):
     return sparse_iFFT2mtx
 
 
-def dcg_solver(A, b, mu,niter,x0=None):
+def create_iFFT2operator(shape, T=None, Y=None, support=None):
+    """
+    Matrix-free counterpart of create_iFFT2mtx. Creates the operator
+
+                            A = T * FH * Yw
+
+    for the row-wise ordered longvector of an array of the given shape, as
+    used in bowpy.filter.fk.fk_reconstruct. The products A*x and A^H*y are
+    evaluated with fftutil.ifft2 and fftutil.fft2, so no (nx*ny)x(nx*ny) matrix
+    is stored and each application costs O(N log N).
+
+    :param shape: Shape (nx, ny) of the f-k spectrum
+    :type  shape: tuple
+
+    :param T: Diagonal of the sampling matrix T, if None T = I
+    :type  T: numpy.ndarray
+
+    :param Y: Diagonal of the mask matrix Yw, if None Yw = I
+    :type  Y: numpy.ndarray
+
+    :param support: Indices of the longvector entries to solve for, usually the
+                    nonzero entries of Y. If set, A acts on the compressed vector
+                    of length support.size, which is scattered into the full
+                    spectrum before and gathered from it after the transforms.
+    :type  support: numpy.ndarray
+
+    returns
+    :param A: Operator of size (nx*ny)x(nx*ny), or (nx*ny)x(support.size)
+    :type  A: scipy.sparse.linalg.LinearOperator
+    """
+    nx, ny = shape
+    N = nx * ny
+
+    if support is None:
+        M = N
+        Ys = Y
+    else:
+        M = support.size
+        Ys = None if Y is None else Y[support]
+
+    def matvec(x):
+        x = x.ravel()
+        if Ys is not None:
+            x = Ys * x
+        if support is not None:
+            x_full = np.zeros(N, dtype='complex')
+            x_full[support] = x
+            x = x_full
+        d = fftutil.ifft2(x.reshape(shape)).ravel()
+        if T is not None:
+            d = T * d
+        return d
+
+    def rmatvec(d):
+        d = d.ravel()
+        if T is not None:
+            d = np.conj(T) * d
+        # Adjoint of the normalized iFFT2 is the unnormalized FFT2 / N.
+        x = fftutil.fft2(d.reshape(shape)).ravel() / float(N)
+        if support is not None:
+            x = x[support]
+        if Ys is not None:
+            x = np.conj(Ys) * x
+        return x
+
+    return sparse.linalg.LinearOperator((N, M), matvec=matvec, rmatvec=rmatvec,
+                                        dtype='complex')
+
+
+def dcg_solver(A, b, mu, niter, x0=None, tol=None, precond=None, callback=None):
     """
     Damped conjugate gradient solver for Ax = b lstsqs problems, as shown in Tomographic
     inversion via the conjugate gradient method, Scales, J. 1987
@@ -187,69 +264,80 @@ def dcg_solver(A, b, mu,niter,x0=None):
 
                 ==>		min || G * m - d || ^{2}_{2}
 
-    """
-    print("--- Using dCG-method --- \n \nInitiating matrices... \n \n")
-
-    # Create G matrix and d Vector.
-
-    I = mu**2. * sparse.identity(A.shape[0])
-
-    G = sparse.lil_matrix(np.vstack((A.toarray(), I.toarray())))
-    G = G.tocsc()
+    G is not built, A is only used by its products with vectors and its adjoint, it can
+    be an array, a sparse matrix or a scipy.sparse.linalg.LinearOperator.
 
-    d = np.hstack( (b, np.zeros(I.shape[0])) )
+    :param A: Matrix or operator
+    :type A: numpy.ndarray, scipy.sparse matrix or scipy.sparse.linalg.LinearOperator
 
+    :param b: Right hand side
+    :type b: numpy.ndarray
 
-    # Initialize startvalues.
-    try:
-        if not x0:
-            m = np.zeros(A.shape[1])
-            s = -d
-    except ValueError:
-        if x0.any():
-            m = x0
-            s = G.dot(m) - d
-    except:
-        msg = 'No valid input'
-        raise IOError(msg)
-
-
-    beta_old 	= 0.
-    r 			= G.transpose().conjugate().dot(s)
-    p_old 		= np.zeros(r.shape)
-
-    print("Starting iterations. \n \n")
+    :param mu: Damping
+    :type mu: float
 
-    cont = True
-    k = 1
-    while cont:
+    :param niter: Maximum number of iterations
+    :type niter: int
 
-        p 		= -r + beta_old * p_old
-        alpha 	= np.linalg.norm(r,2)**2. /  p.dot(G.transpose().conjugate().toarray()).dot(G.dot(p))
-        m_new 	= m + alpha * p
-        s_new 	= s + alpha * G.dot(p)
-        r_new	= G.transpose().conjugate().dot(s_new)
-        beta	= np.linalg.norm(r_new,2)**2. / np.linalg.norm(r,2)**2.
+    :param x0: Start value, default is 0
+    :type x0: numpy.ndarray
 
-        m			= m_new.copy()
-        s			= s_new.copy()
-        r			= r_new.copy()
-        beta_old	= beta.copy()
-        p_old		= p.copy()
+    :param tol: The iteration stops if the residual of the normal equations,
+                ||A^H (b - Ax) - mu^2 x||, is below tol times its start value
+    :type tol: float
 
-        misfit 	= np.linalg.norm(G.dot(m) - d, 2)
-        rnorm 	= np.linalg.norm(m,2)**2.
+    :param precond: Diagonal of a right preconditioner, x = precond * z, e.g. the
+                    inverse column norms of A
+    :type precond: numpy.ndarray
 
-        plt.ion()
-        plt.figure()
-        plt.imshow(abs(m.reshape(20,300)),aspect='auto', interpolation='none')
-        plt.show()
+    :param callback: Function called after each iteration as callback(k, x, rnorm),
+                     with rnorm = ||b - Ax||
+    :type callback: function
 
-        if k == niter: cont=False
-        k +=1
+    returns
 
+    :param x: Solution
+    :type x: numpy.ndarray
+    """
+    A = sparse.linalg.aslinearoperator(A)
+    dtype = np.result_type(b, A.dtype, 'float')
+    mu2 = float(mu)**2.
+    w = np.ones(A.shape[1]) if precond is None else np.asarray(precond)
+
+    if x0 is not None and np.any(x0):
+        x = np.array(x0, dtype=dtype)
+        r = b - A.matvec(x)
+    else:
+        x = np.zeros(A.shape[1], dtype=dtype)
+        r = np.array(b, dtype=dtype)
+
+    # CGLS in the preconditioned variable z, with x = w * z.
+    s = w * (A.rmatvec(r) - mu2 * x)
+    p = s.copy()
+    gamma = np.vdot(s, s).real
+    gamma0 = gamma
+
+    for k in range(niter):
+        wp = w * p
+        q = A.matvec(wp)
+        delta = np.vdot(q, q).real + mu2 * np.vdot(wp, wp).real
+        if delta == 0.:
+            break
+        alpha = gamma / delta
+        x += alpha * wp
+        r -= alpha * q
+
+        if callback:
+            callback(k, x, np.linalg.norm(r))
+
+        s = w * (A.rmatvec(r) - mu2 * x)
+        gamma_new = np.vdot(s, s).real
+        if tol and gamma_new <= tol**2. * gamma0:
+            break
+
+        p = s + (gamma_new / gamma) * p
+        gamma = gamma_new
 
-    x = m.copy()
     return x
 
 
@@ -341,6 +429,9 @@ def find_peaks(data, drange=None, peakpick='mod', mindist=0.2):
 def fktrafo(stream, normalize=True):
     """
     Calculates the f,k - transformation of the data in stream. Returns the trafo as an array.
+    Since the data are real, only the half spectrum along the time axis is computed (rfft),
+    the returned array has the shape (iK, iF/2+1), with iK and iF the padded number of traces
+    and samples. Use ifktrafo to transform it back.
 
     :param st: Stream
     :type st: obspy.core.stream.Stream
@@ -359,29 +450,99 @@ def fktrafo(stream, normalize=True):
     ArrayData = stream2array(st_tmp, normalize)
 
     ix = ArrayData.shape[0]
-    iK = int(math.pow(2,nextpow2(ix)))
+    iK = fftutil.fast_len(ix)
     it = ArrayData.shape[1]
-    iF = int(math.pow(2,nextpow2(it)))
+    iF = fftutil.fast_len(it)
 
-    fkdata = np.fft.fft2(ArrayData, s=(iK,iF))
+    fkdata = fftutil.rfft2(ArrayData, s=(iK,iF))
 
     return fkdata
 
 
+def fx_solver(data, W, noft, mu, workers=None):
+    """
+    Solves the damped least-squares problem of fk_reconstruct separately for
+    every temporal frequency. After an FFT along the time axis the cost function
+
+            J = ||dv - T FHmtx2D Yw Dv ||^{2}_{2} + mu^2 ||Dv||^{2}_{2}
+
+    splits into one small k-domain problem per frequency slice f,
+
+            J_f = ||d_f - T_x iDFT_x Yw_f D_f ||^{2}_{2} + nt mu^2 ||D_f||^{2}_{2}
+
+    with the same trace sampling T_x for each slice. Only the coefficients on the
+    support of the mask column Yw_f are solved for. The solution operator of a slice
+    depends on its mask column only, so all slices with the same column share one
+    factorization and are solved with one matrix product. The groups of slices are
+    solved in a thread pool.
+
+    :param data: Array data with zero-filled missing traces, traces are rows
+    :type  data: numpy.ndarray
+
+    :param W: Mask function, see makeMask, same shape as data
+    :type  W: numpy.ndarray
+
+    :param noft: Indices of the missing traces
+    :type  noft: list
+
+    :param mu: Damping parameter
+    :type  mu: float
+
+    :param workers: Number of threads, default of concurrent.futures if None
+    :type  workers: int
+
+    returns
+    :param D: f-k spectrum of the reconstructed data, same shape as data
+    :type  D: numpy.ndarray
+    """
+    nx, nt = data.shape
+    live = np.ones(nx, dtype=bool)
+    live[list(noft)] = False
+    lam = nt * mu**2.
+
+    DF = np.fft.fft(data, axis=1)[live]
+    D = np.zeros(data.shape, dtype='complex')
+
+    # Columns of the inverse DFT along the distance axis, sampled on live traces.
+    iDFTx = np.fft.ifft(np.identity(nx), axis=0)[live]
+
+    # Group frequency slices by their mask column.
+    groups = {}
+    for f in range(nt):
+        groups.setdefault(W[:, f].tobytes(), []).append(f)
+
+    def solve(fidx):
+        Yf = W[:, fidx[0]]
+        s = np.nonzero(Yf)[0]
+        if s.size == 0:
+            return
+        A = iDFTx[:, s] * Yf[s]
+        Ah = A.conj().transpose()
+        if lam > 0:
+            K = sp.linalg.cho_solve(sp.linalg.cho_factor(Ah.dot(A) + lam * np.identity(s.size)), Ah)
+        else:
+            K = np.linalg.pinv(A)
+        D[np.ix_(s, fidx)] = K.dot(DF[:, fidx])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(solve, groups.values()))
+
+    return D
+
+
 def ifktrafo(fkdata, stream, normalize=True):
     """
     Calculates the inverse f,k - transformation of the data in fkdata. Returns the trafo as an array.
+    fkdata is the half spectrum along the time axis, as returned by fktrafo.
 
     """
     StreamData= stream2array(stream)
     ix   = StreamData.shape[0]
-    iK   = int(math.pow(2,nextpow2(ix)))
+    iK   = fftutil.fast_len(ix)
     it   = StreamData.shape[1]
-    iF   = int(math.pow(2,nextpow2(it)))
-
-    fk_tmp = fkdata.copy()
+    iF   = fftutil.fast_len(it)
 
-    ArrayData = np.fft.ifft2(fkdata, s=(iK,iF))
+    ArrayData = fftutil.irfft2(fkdata, s=(iK,iF))
     ArrayData = ArrayData[0:ix, 0:it]
 
     return ArrayData
@@ -408,31 +569,140 @@ def ls2ifft_prep(ls_periodogram, data):
     to perform an IRFFT
     """
     fft_prep = np.roll(ls_periodogram, 1)
-    N = data.size
-    a = 0
-    for i in range(N):
-        a = a + data[i]
-    a = a/N
-    fft_prep[0] = a
+    fft_prep[0] = np.mean(data)
     return(fft_prep)
 
 
-def lstsqs(A,b,mu=0):
+def lsfk(data, x, nf=None, dx=None):
+    """
+    Lomb-Scargle f-k transformation of traces at irregular positions x. After an rfft
+    along the time axis, the cos and sin amplitudes of every wavenumber are fitted to
+    each frequency column by least squares, with the time shift tau of Lomb-Scargle,
+    which makes the cos and sin terms orthogonal:
 
-    print("Calculating AhA")
-    Ah = A.conjugate().transpose()
-    AhA= Ah.dot(A)
+        A(k, f) = sum_j d(x_j, f) cos(w_k (x_j - tau_k)) / sum_j cos^2(w_k (x_j - tau_k))
+        B(k, f) = sum_j d(x_j, f) sin(w_k (x_j - tau_k)) / sum_j sin^2(w_k (x_j - tau_k))
 
-    print("Calculating I")
-    I = sparse.identity(A.shape[0])
+    with w_k = 2 pi k / (nx dx), k = 0 ... nx/2. All frequencies are done by one matrix
+    product with the cos and sin basis, which is cached per set of positions. The
+    periodogram is 0.5 * (|A|^2 sum cos^2 + |B|^2 sum sin^2). On a regular grid
+    A and B are the Fourier coefficients and ilsfk is the inverse transformation.
 
-    tmp = AhA + mu*I
-    tmpI = sparse.linalg.inv(tmp)
+    :param data: Data, traces are rows
+    :type  data: numpy.ndarray
 
-    print("Calculating x")
-    x = tmpI.dot(Ah.dot(b))
-    print("..finished")
-    return x
+    :param x: Positions of the traces, e.g. epicentral distances
+    :type  x: numpy.ndarray
+
+    :param nf: Padded number of samples, default is fftutil.fast_len of the number of samples
+    :type  nf: int
+
+    :param dx: Spacing of the wavenumbers is 1/(nx*dx), default is the mean spacing of x
+    :type  dx: float
+
+    returns
+
+    :param A: cos amplitudes, shape (nx/2+1, nf/2+1)
+    :type  A: numpy.ndarray
+
+    :param B: sin amplitudes, same shape as A
+    :type  B: numpy.ndarray
+
+    :param k: Wavenumbers, in 1/unit of x
+    :type  k: numpy.ndarray
+    """
+    if nf is None:
+        nf = fftutil.fast_len(data.shape[1])
+    k, C, S, nc, ns = _ls_basis(tuple(np.asarray(x, dtype='float')), dx)
+    fxdata = fftutil.rfft(data, nf, axis=1)
+
+    A = C.dot(fxdata) / nc[:, np.newaxis]
+    B = S.dot(fxdata) / ns[:, np.newaxis]
+
+    return A, B, k
+
+
+def ilsfk(A, B, x, nt=None, dx=None):
+    """
+    Evaluates the Lomb-Scargle amplitudes of lsfk at the positions x and transforms them
+    back to the time domain.
+
+    :param A: cos amplitudes, from lsfk
+    :type  A: numpy.ndarray
+
+    :param B: sin amplitudes, from lsfk
+    :type  B: numpy.ndarray
+
+    :param x: Positions of the traces
+    :type  x: numpy.ndarray
+
+    :param nt: Number of samples of the traces, default is the padded number of samples
+    :type  nt: int
+
+    :param dx: Spacing used for lsfk
+    :type  dx: float
+    """
+    nf = 2 * (A.shape[1] - 1)
+    if nt is None:
+        nt = nf
+    k, C, S, nc, ns = _ls_basis(tuple(np.asarray(x, dtype='float')), dx)
+    fxdata = C.T.dot(A) + S.T.dot(B)
+
+    return fftutil.irfft(fxdata, nf, axis=1)[:, 0:nt]
+
+
+@lru_cache(maxsize=16)
+def _ls_basis(x, dx):
+    """
+    Returns the wavenumbers, the cos and sin basis of lsfk for the positions x and the
+    sums of their squares. The sin terms of k=0, and of the Nyquist wavenumber on a
+    regular grid, vanish, their sums are set to inf, so that B is 0.
+    """
+    x = np.array(x)
+    if dx is None:
+        dx = (x.max() - x.min()) / max(x.size - 1, 1)
+    k = np.arange(x.size // 2 + 1) / (x.size * dx)
+    w = 2. * np.pi * k
+
+    tau = np.zeros(k.size)
+    tau[1:] = np.arctan2(np.sin(2. * np.outer(w[1:], x)).sum(axis=1),
+                         np.cos(2. * np.outer(w[1:], x)).sum(axis=1)) / (2. * w[1:])
+    phase = w[:, np.newaxis] * (x - tau[:, np.newaxis])
+    C = np.cos(phase)
+    S = np.sin(phase)
+    nc = np.sum(C**2., axis=1)
+    ns = np.sum(S**2., axis=1)
+    ns[ns < 1e-10 * x.size] = np.inf
+
+    for array in (k, C, S, nc, ns):
+        array.flags.writeable = False
+
+    return k, C, S, nc, ns
+
+
+def lstsqs(A, b, mu=0, niter=None, tol=1e-10, precond=None, callback=None):
+    """
+    Damped least-squares solution x = (A^H A + mu I)^-1 A^H b, computed by the
+    matrix-free CGLS of dcg_solver with damping sqrt(mu), instead of an explicit inverse.
+
+    :param A: Matrix or operator
+    :type A: numpy.ndarray, scipy.sparse matrix or scipy.sparse.linalg.LinearOperator
+
+    :param b: Right hand side
+    :type b: numpy.ndarray
+
+    :param mu: Damping
+    :type mu: float
+
+    :param niter: Maximum number of iterations, default is the number of unknowns
+    :type niter: int
+
+    :param tol: Tolerance, see dcg_solver
+    :type tol: float
+    """
+    if niter is None:
+        niter = A.shape[1]
+    return dcg_solver(A, b, np.sqrt(mu), niter, tol=tol, precond=precond, callback=callback)
 
 
 def makeMask(fkdata, slope, shape, rth=0.4, expl_cutoff=False):
@@ -441,16 +711,26 @@ def makeMask(fkdata, slope, shape, rth=0.4, expl_cutoff=False):
     with straight lines (value = 1.) along the angles, given in slope and 0 everywhere else.
     slope shows the position of L linear dominants in the f-k domain.
 
-    :param fkdata:
+    The lobes are rasterized directly on the grid of fkdata, along the lines
 
-    :param slope:
+                            k = -p * f,    p = slope * 1/2 * nk/nf,
+
+    with f the signed frequency index, as used in slope_distribution. The masks are
+    cached by (shape, rounded slopes, shape, rth, cutoff), the returned array is
+    read-only.
+
+    :param fkdata: f-k spectrum, only its shape is used
+
+    :param slope: slopes of the lines, as returned by slope_distribution
 
     :param shape: shape[0] describes the shape of the lobes of the mask. Possible inputs are:
                  -boxcar (default)
                  -taper
                  -butterworth
 
-                  shape[1] is an additional attribute to the shape of taper and butterworth, for:
+                  shape[1] is an additional attribute to the shape of the lobes, for:
+                 -boxcar: maskshape[1] = width of the lobes along k, default is
+                          the number of slopes
                  -taper: maskshape[1] = slope of sides
                  -butterworth: maskshape[1] = number of poles
 
@@ -459,88 +739,238 @@ def makeMask(fkdata, slope, shape, rth=0.4, expl_cutoff=False):
 
     :type  maskshape: list
 
-    :param rth =  Resamplethreshhold, marks the border between 0 and 1 for the resampling
+    :param rth: Threshold of the boxcar lobes, a sample is set to 1 if the lobe covers
+                more than rth of it along k
+    :type  rth: float
+
+    :param expl_cutoff: cutoff of the taper and butterworth lobes, default is half the
+                        number of slopes
+
     Returns
 
     :param W: Mask function W
     """
-    M 			= fkdata.copy()
-
-    # Because of resolution issues, upsampling to double size
-    pnorm 		= 1/2. * ( float(M.shape[0]+1)/float(2. * M.shape[1]) )
-
-    prange 		= slope * pnorm
-    Mask 		= np.zeros((M.shape[0], 2.*M.shape[1]))
-    maskshape 	= np.zeros((M.shape[0], 2.*M.shape[1]))
-    W 			= np.zeros((M.shape[0], 2.*M.shape[1]))
-    name 		= shape[0]
-    arg 		= shape[1]
+    slope = np.round(np.atleast_1d(np.asarray(slope, dtype='float')), MASK_DECIMALS)
+    name = shape[0]
+    arg = shape[1]
 
     if name in ['butterworth', 'Butterworth', 'taper', 'Taper']:
         if not expl_cutoff:
-            cutoff 	= slope.size/2
+            cutoff 	= slope.size//2
         else:
             cutoff 	= expl_cutoff
 
         if cutoff < 1: cutoff = 1
-        maskshape_tmp 	= create_filter(name, Mask.shape[0]/2, cutoff, arg)
-        maskshape_lh 	= np.tile(maskshape_tmp, Mask.shape[1]).reshape(Mask.shape[1], maskshape_tmp.size).transpose()
-        maskshape_rh 	= np.flipud(maskshape_lh)
+    else:
+        cutoff = None
 
-        maskshape[:maskshape.shape[0]/2,:] = maskshape_lh
-        maskshape[maskshape.shape[0]/2:,:] = maskshape_rh
+    return _mask_table(fkdata.shape, tuple(slope), name, arg, float(rth), cutoff)
 
 
-    for m in prange:
-        if m == 0.:
-            Mask[0,:] = 1.
-            Mask[1,:] = 1.
-            Mask[Mask.shape[0]-1,:] = 1.
+# Number of decimals the slopes are rounded to, before a mask is built or
+# looked up in the cache of makeMask.
+MASK_DECIMALS = 4
 
-        for f in range(Mask.shape[1]):
-            Mask[:,f] = np.roll(Mask[:,f], -int(math.floor(f*m)))
 
-        if name in ['boxcar']:
-            Mask[0,:] = 1.
-        else:
-            Mask = maskshape.copy()
+@lru_cache(maxsize=64)
+def _mask_table(shape, slopes, name, arg, rth, cutoff):
+    """
+    Builds the mask of makeMask for the spectrum shape and the given slopes.
+    """
+    nk, nf = shape
+    pnorm = 1/2. * ( float(nk)/float(nf) )
+    f = np.fft.fftfreq(nf, 1./nf)
+    k = np.arange(nk)[:, np.newaxis]
 
-        for f in range(Mask.shape[1]):
-            Mask[:,f] = np.roll(Mask[:,f], int(f*m))
+    lobe = None
+    if name in ['butterworth', 'Butterworth', 'taper', 'Taper']:
+        lobe = create_filter(name, nk//2, cutoff, arg)
+    elif arg:
+        width = float(arg)
+    else:
+        width = float(len(slopes))
 
-        W += Mask
-        Mask =  np.zeros((M.shape[0], 2.*M.shape[1]))
+    W = np.zeros(shape)
+    for m in slopes:
+        # Circular distance along k of every sample to the line k = -m*pnorm*f.
+        dist = np.abs(np.mod(k + m*pnorm*f + nk/2., nk) - nk/2.)
 
-    # Convolving each frequency slice of the mask with a boxcar
-    # of size L. Widens the the maskfunction along k-axis.
-    if name in ['boxcar']:
-        if arg:
-            b = sp.signal.boxcar(arg)
+        if lobe is None:
+            # Part of each sample covered by a lobe of the given width.
+            cover = np.clip(width/2. - dist + 0.5, 0., 1.)
+            W[cover > rth] = 1.
         else:
-            b = sp.signal.boxcar(slope.size)
-        for i, fslice in enumerate(W.conj().transpose()):
-            W[:,i] = sp.signal.convolve(fslice, b, mode=1)
+            W += np.interp(dist, np.arange(lobe.size), lobe)
+
+    # Negative frequencies as point reflection of the positive ones, W(k,-f) = W(-k,f),
+    # so the filtered data stay real.
+    fpos = np.arange(1, (nf+1)//2)
+    W[:, nf-fpos] = np.roll(W[::-1, fpos], 1, axis=0)
+    W[W > 1.] = 1.
+    W.setflags(write=False)
+
+    return W
+
+
+def nufft_fk(data, x, nk=None, nf=None, dx=None, niter=0, tol=1e-6, eps=1e-12):
+    """
+    f-k transformation of traces at irregular positions x, without placing them on a
+    grid. Along the time axis an rfft is applied, along the traces a non-uniform FFT by
+    Gaussian gridding (Greengard & Lee, 2004): the traces are spread with a Gaussian
+    to an oversampled regular grid, transformed by an FFT, and the Gaussian is divided
+    out again. The returned array has the same layout as fftutil.rfft2(data, s=(nk, nf)),
+    on a regular grid with spacing dx both are equal up to eps. Use nufft_ifk for the
+    adjoint transformation.
+
+    On irregular positions nufft_ifk is not the inverse of this transformation. With
+    niter > 0 the least-squares spectrum is returned instead, the spectrum whose
+    nufft_ifk fits the data best, found by CGLS separately for every frequency.
+
+    :param data: Data, traces are rows
+    :type  data: numpy.ndarray
+
+    :param x: Positions of the traces, e.g. epicentral distances from trace.stats.distance
+    :type  x: numpy.ndarray
+
+    :param nk: Number of wavenumbers, default is fftutil.fast_len of the number of traces
+    :type  nk: int
+
+    :param nf: Padded number of samples, default is fftutil.fast_len of the number of samples
+    :type  nf: int
+
+    :param dx: Spacing of the wavenumber axis is 1/(nk*dx), default is the mean spacing of x
+    :type  dx: float
+
+    :param niter: Maximum number of CGLS iterations of the least-squares spectrum, 0 returns
+                  the plain transformation
+    :type  niter: int
 
-        W[np.where(W!=0)]=1.
+    :param tol: Relative residual of the normal equations, to stop the CGLS iteration
+    :type  tol: float
 
-        W[np.where(W > 1.)]=1.
+    :param eps: Accuracy of the transformation
+    :type  eps: float
 
-    # Resample it to original size
-    Wr = np.flipud(sp.signal.resample(W, M.shape[1], axis=1))
-    Wr[ np.where(Wr > 1 ) ] = 1.
-    Wr[ np.where(Wr < 0 ) ] = 0.
-    if name in ['boxcar']:
-        Wr[ np.where(Wr > rth ) ] = 1.
-        Wr[ np.where(Wr < rth ) ] = 0.
+    returns
+
+    :param fkdata: f,k - transformation of data, shape (nk, nf/2+1)
+    :type  fkdata: numpy.ndarray
+    """
+    nx, it = data.shape
+    if nk is None:
+        nk = fftutil.fast_len(nx)
+    if nf is None:
+        nf = fftutil.fast_len(it)
+
+    S, nr, deconv = _nufft_plan(np.asarray(x, dtype='float'), nk, dx, eps)
+    k = _nufft_modes(nk) % nr
+    deconv = deconv[:, np.newaxis]
+
+    def forward(fxdata):
+        return deconv * fftutil.fft(S.dot(fxdata), axis=0)[k] / nr
+
+    def adjoint(fkdata):
+        grid = np.zeros((nr, fkdata.shape[1]), dtype='complex')
+        grid[k] = deconv * fkdata
+        return S.T.dot(fftutil.ifft(grid, axis=0))
+
+    fxdata = fftutil.rfft(data, nf, axis=1)
+    if not niter:
+        return forward(fxdata)
+
+    # CGLS for min ||adjoint(m) - fxdata||, every frequency is a column of its own.
+    # nufft_ifk is adjoint/nk, so the solution is scaled by nk.
+    fkdata = np.zeros((nk, fxdata.shape[1]), dtype='complex')
+    r = fxdata
+    g = forward(r)
+    p = g.copy()
+    gamma = np.sum(abs(g)**2., axis=0)
+    gamma0 = gamma.copy()
+    for i in range(niter):
+        q = adjoint(p)
+        qq = np.sum(abs(q)**2., axis=0)
+        step = np.divide(gamma, qq, out=np.zeros_like(gamma), where=qq > 0)
+        fkdata += step * p
+        r = r - step * q
+        g = forward(r)
+        gamma_new = np.sum(abs(g)**2., axis=0)
+        if np.all(gamma_new <= tol**2. * gamma0):
+            break
+        beta = np.divide(gamma_new, gamma, out=np.zeros_like(gamma), where=gamma > 0)
+        p = g + beta * p
+        gamma = gamma_new
+
+    return fkdata * nk
+
+
+def nufft_ifk(fkdata, x, nt=None, dx=None, eps=1e-12):
+    """
+    Adjoint of nufft_fk, evaluates the f-k spectrum at the irregular positions x and
+    transforms it back to the time domain. It is scaled as fftutil.irfft2, so on a
+    regular grid it is the inverse of nufft_fk. For irregular positions it is the
+    inverse of the least-squares spectrum of nufft_fk with niter > 0.
+
+    :param fkdata: f,k - spectrum, shape (nk, nf/2+1), as from nufft_fk
+    :type  fkdata: numpy.ndarray
+
+    :param x: Positions of the traces
+    :type  x: numpy.ndarray
+
+    :param nt: Number of samples of the traces, default is the padded number of samples
+    :type  nt: int
+
+    :param dx: Spacing used for nufft_fk
+    :type  dx: float
+
+    :param eps: Accuracy of the transformation
+    :type  eps: float
+
+    returns
+
+    :param data: Traces at the positions x
+    :type  data: numpy.ndarray
+    """
+    nk = fkdata.shape[0]
+    nf = 2 * (fkdata.shape[1] - 1)
+    if nt is None:
+        nt = nf
+
+    S, nr, deconv = _nufft_plan(np.asarray(x, dtype='float'), nk, dx, eps)
+    grid = np.zeros((nr, fkdata.shape[1]), dtype='complex')
+    grid[_nufft_modes(nk) % nr] = deconv[:, np.newaxis] * fkdata
+    fxdata = S.T.dot(fftutil.ifft(grid, axis=0)) / nk
+
+    return fftutil.irfft(fxdata, nf, axis=1)[:, 0:nt]
+
+
+def _nufft_modes(nk):
+    # Wavenumber indices in the order of numpy.fft.fft, 0 ... nk/2-1, -nk/2 ... -1.
+    return np.round(np.fft.fftfreq(nk) * nk).astype('int')
+
+
+def _nufft_plan(x, nk, dx, eps):
+    """
+    Returns the sparse spreading matrix of the positions x to the oversampled grid, the
+    size of the grid and the deconvolution of the Gaussian for each wavenumber.
+    """
+    if dx is None:
+        dx = (x.max() - x.min()) / max(x.size - 1, 1)
+    R = 2.
+    nr = fftutil.fast_len(int(R * nk))
+    R = float(nr) / nk
+    msp = int(np.ceil(-np.log(eps) / (np.pi * (R - 1.) / (R - 0.5))))
+    tau = np.pi * msp / (nk**2. * R * (R - 0.5))
 
+    theta = 2. * np.pi * (x - x.min()) / (nk * dx)
+    m = np.round(theta * nr / (2. * np.pi)).astype('int')[:, np.newaxis] + np.arange(-msp, msp + 1)
+    w = np.exp(-(theta[:, np.newaxis] - 2. * np.pi * m / nr)**2. / (4. * tau))
+    cols = np.repeat(np.arange(x.size), 2 * msp + 1)
+    S = sparse.csr_matrix((w.ravel(), ((m % nr).ravel(), cols)), shape=(nr, x.size))
 
-    Wlhs	= np.roll(Wr[:,0:Wr.shape[1]/2-1], shift=1, axis=0)
-    Wrhs	= Wr[:,1:Wr.shape[1]/2+1]
-    Wrhs 	= np.roll(np.flipud(np.fliplr(Wrhs)), shift=0, axis=0)
+    k = _nufft_modes(nk)
+    deconv = np.sqrt(np.pi / tau) * np.exp(k**2. * tau)
 
-    Wr[:,0:Wr.shape[1]/2-1] = Wlhs
-    Wr[:,Wr.shape[1]/2:] = Wrhs
-    return Wr
+    return S, nr, deconv
 
 
 def plot(st, inv=None, event=None, zoom=1, yinfo=False, stationlabel=True, epidistances=None, markphases=None, phaselabel=True, phaselabelclr='red',
@@ -1117,7 +1547,534 @@ def plotfk(data, fs=15, savefig=False, dpi=400, logscale=False, hold=False, cmap
             plt.show()
 
 
-def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='denoise', peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, overlap=0.5, plotfeedback=False):
+def pocs_engine(data, noft, maxiter, alpha, method='linear', threshold=None, shape=None, tol=None, callback=None,
+                i0=0):
+    """
+    Iteration kernel of the pocs algorithm with a 'linear' or 'exp' decrease of the
+    threshold. Works on arrays of any dimension, which are transformed along all axes.
+    The traces in noft are indexed along the first axis, or by a boolean mask of the
+    leading axes, e.g. of the grid cells of a (y, x, t) array.
+
+    All work arrays are allocated once before the iteration. The spectrum is thresholded
+    in place with a boolean mask computed from its squared magnitude and only the rows
+    in noft are written back. If tol is set, the iteration stops as soon as the relative
+    change of the reconstructed traces is below tol.
+
+    :param data: Data with zero-filled traces to be reconstructed
+    :type  data: numpy.ndarray
+
+    :param noft: Indices of the traces to be reconstructed, or a boolean mask of the
+                 leading axes of data
+    :type  noft: list or numpy.ndarray
+
+    :param maxiter: Maximum number of iterations
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param method: Decrease of the threshold, 'linear' or 'exp'
+    :type  method: string
+
+    :param threshold: Start threshold, default is the absolute value of the maximum
+                      of the spectrum of data
+    :type  threshold: float
+
+    :param shape: Shape of the padded FFT, default is fftutil.fast_shape(data.shape)
+    :type  shape: tuple
+
+    :param tol: Tolerance of the convergence test, if None all maxiter iterations are done
+    :type  tol: float
+
+    :param callback: Function called after each iteration as callback(i, datap)
+    :type  callback: function
+
+    :param i0: Number of iterations already done, e.g. on a coarser grid. The 'exp'
+               schedule continues with the factor exp(-(i0+i+1)*alpha) of iteration i0+i.
+    :type  i0: int
+
+    returns:
+
+    :param datap: Reconstructed data, same shape as data
+    :type  datap: numpy.ndarray
+
+    :param niter: Number of iterations done
+    :type  niter: int
+    """
+    if shape is None:
+        shape = fftutil.fast_shape(data.shape)
+    window = tuple(slice(0, n) for n in data.shape)
+    noft = np.asarray(noft)
+    if noft.dtype == bool:
+        rows = np.nonzero(noft)
+    else:
+        rows = noft.astype('int')
+
+    # Preallocate the padded data and the buffers of the half spectrum.
+    buf = np.zeros(shape)
+    buf[window] = data
+    datap = buf[window]
+    spec_shape = tuple(shape[:-1]) + (shape[-1] // 2 + 1,)
+    mag = np.empty(spec_shape)
+    mag_imag = np.empty(spec_shape)
+    kill = np.empty(spec_shape, dtype='bool')
+    if tol:
+        old = np.empty(datap[rows].shape)
+
+    # The schedule works on the squared threshold. The default start value is
+    # squared the same way as mag, so the largest coefficient is kept exactly.
+    if threshold is None:
+        fkmax = fftutil.rfftn(buf).max()
+        threshold2 = np.square(fkmax.real) + np.square(fkmax.imag)
+    else:
+        threshold2 = threshold**2.
+
+    niter = 0
+    for i in range(maxiter):
+        fkdata = fftutil.rfftn(buf)
+        np.square(fkdata.real, out=mag)
+        np.square(fkdata.imag, out=mag_imag)
+        mag += mag_imag
+        np.less(mag, threshold2, out=kill)
+        np.copyto(fkdata, 0., where=kill)
+
+        if method in ('linear'):
+            threshold2 = threshold2 * alpha**2.
+        elif method in ('exp'):
+            threshold2 = threshold2 * np.exp(-(i0+i+1) * alpha)**2.
+
+        if tol:
+            old[:] = datap[rows]
+        datap[rows] = fftutil.irfftn(fkdata, s=shape, axes=tuple(range(len(shape))))[window][rows]
+        niter = i + 1
+
+        if callback:
+            callback(i, datap)
+
+        if tol and np.linalg.norm(datap[rows] - old) <= tol * np.linalg.norm(datap[rows]):
+            break
+
+    return datap.copy(), niter
+
+
+def pocs_multigrid(data, noft, maxiter, alpha, method='linear', levels=2, factor=2, fineiter=None,
+                   threshold=None, tol=None, callback=None):
+    """
+    Coarse-to-fine version of pocs_engine. The traces are first decimated in time by
+    factor**(levels-1), by cutting their spectrum, and reconstructed on this coarse grid.
+    The result is resampled to the next finer grid, where it is the initial guess of the
+    traces in noft, and the iteration continues with the threshold the coarser level
+    ended with. On the finest level, the original data, only the remaining, mostly high
+    frequency, details are refined.
+
+    The maxiter steps of the threshold schedule are split between the levels, each finer
+    level does fineiter of them and the coarsest level the rest. Each level continues
+    the schedule with the iterations of the coarser levels counted (see i0 of
+    pocs_engine), so for 'linear' and 'exp' the final threshold is the same as of
+    pocs_engine with maxiter iterations, but only fineiter of them are done in full size.
+
+    :param data: Data with zero-filled traces to be reconstructed
+    :type  data: numpy.ndarray
+
+    :param noft: Indices of the traces to be reconstructed
+    :type  noft: list
+
+    :param maxiter: Maximum number of iterations, summed over all levels
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param method: Decrease of the threshold, 'linear' or 'exp'
+    :type  method: string
+
+    :param levels: Number of levels, including the original data
+    :type  levels: int
+
+    :param factor: Decimation factor between two levels
+    :type  factor: int
+
+    :param fineiter: Maximum number of iterations on each level but the coarsest, default
+                     is maxiter // (2*levels)
+    :type  fineiter: int
+
+    :param threshold: Start threshold on the coarsest level, relative to the maximum of its
+                      spectrum, default is 1
+    :type  threshold: float
+
+    :param tol: Tolerance of the convergence test on each level, see pocs_engine
+    :type  tol: float
+
+    :param callback: Function called after each iteration on the finest level, see pocs_engine
+    :type  callback: function
+
+    returns:
+
+    :param datap: Reconstructed data, same shape as data
+    :type  datap: numpy.ndarray
+
+    :param niter: Number of iterations done on the finest level
+    :type  niter: int
+    """
+    if fineiter is None:
+        fineiter = max(1, maxiter // (2 * levels))
+    coarseiter = max(0, maxiter - (levels - 1) * fineiter)
+    if threshold is None:
+        threshold = 1.
+    it = data.shape[-1]
+    rows = np.asarray(noft, dtype='int')
+
+    datap = None
+    done = 0
+    for l in reversed(range(levels)):
+        if l == 0:
+            ADlevel = data.astype('float')
+        else:
+            ADlevel = _resample(data, max(2, int(math.ceil(it / float(factor**l)))))
+        if datap is not None:
+            ADlevel[rows] = _resample(datap, ADlevel.shape[-1])[rows]
+
+        shape = fftutil.fast_shape(ADlevel.shape)
+        fkmax = abs(fftutil.rfft2(ADlevel, s=shape).max())
+        iterations = coarseiter if datap is None else fineiter
+        datap, niter = pocs_engine(ADlevel, rows, iterations, alpha, method, threshold=threshold * fkmax,
+                                   shape=shape, tol=tol, callback=callback if l == 0 else None, i0=done)
+
+        # The next level continues the schedule where this one ended, the 'exp'
+        # factors of iterations done+1, ..., done+niter were applied.
+        if method in ('linear'):
+            threshold = threshold * alpha**niter
+        elif method in ('exp'):
+            threshold = threshold * np.exp(-alpha * (niter * done + niter * (niter + 1) / 2.))
+        done += niter
+
+    return datap, niter
+
+
+def _resample(data, n):
+    """
+    Resamples the traces of data to n samples, by cutting or zero-padding their spectrum.
+    """
+    it = data.shape[-1]
+    return fftutil.irfft(fftutil.rfft(data, axis=-1), n, axis=-1) * (float(n) / it)
+
+
+def pocs3d(data, maxiter, alpha, noft=None, method='linear', patch=None, overlap=0.5, tol=None, workers=None,
+           threshold=None, callback=None):
+    """
+    Reconstructs the empty cells of a 2D array of stations on a regular grid, e.g. from
+    bowpy.util.array_util.gaps_fill_grid, in the (ky, kx, f) domain. The pocs algorithm
+    works on the whole grid of shape (y, x, samples) at once, by pocs_engine, or on
+    overlapping patches of it, by pocs_tiled.
+
+    :param data: Data of the grid, with zero-filled traces in the empty cells
+    :type  data: numpy.ndarray
+
+    :param maxiter: Maximum number of iterations
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param noft: Boolean mask of shape (y, x) of the cells to be reconstructed, default
+                 are the cells with zero traces
+    :type  noft: numpy.ndarray
+
+    :param method: Decrease of the threshold, 'linear' or 'exp'
+    :type  method: string
+
+    :param patch: Size (y, x, samples) of the patches, if None the whole grid is
+                  reconstructed at once, see pocs_tiled
+    :type  patch: tuple
+
+    :param overlap: Overlap of the patches, as part of the patch size
+    :type  overlap: float
+
+    :param tol: Tolerance of the convergence test, see pocs_engine
+    :type  tol: float
+
+    :param workers: Number of processes reconstructing the patches, see pocs_tiled
+    :type  workers: int
+
+    :param threshold: Start threshold, relative to the maximum of the spectrum, default is 1
+    :type  threshold: float
+
+    :param callback: Function called after each iteration of the whole grid, see pocs_engine
+    :type  callback: function
+
+    returns:
+
+    :param datap: Reconstructed data, same shape as data
+    :type  datap: numpy.ndarray
+    """
+    data = np.asarray(data, dtype='float')
+    if data.ndim != 3:
+        raise IOError('data must have the shape (y, x, samples)')
+    if noft is None:
+        noft = ~data.any(axis=-1)
+
+    if patch is not None:
+        return pocs_tiled(data, noft, maxiter, alpha, method, patch, overlap, tol, workers, threshold)
+
+    shape = fftutil.fast_shape(data.shape)
+    if threshold is not None:
+        threshold = threshold * abs(fftutil.rfftn(data, s=shape).max())
+
+    return pocs_engine(data, noft, maxiter, alpha, method, threshold=threshold, shape=shape, tol=tol,
+                       callback=callback)[0]
+
+
+def pocs_batch(data, noft, maxiter, alpha, method='linear', tol=None, callback=None):
+    """
+    Batched version of pocs_engine for a stack of gathers recorded on the same array,
+    data has the shape (events, traces, samples). Every event is thresholded with its
+    own start threshold and schedule, as by pocs_engine, but all events are transformed
+    by one 2D FFT along the last two axes per iteration. The result of each event is
+    the same as of pocs_engine on this event alone.
+
+    :param data: Stack of gathers with zero-filled traces to be reconstructed
+    :type  data: numpy.ndarray
+
+    :param noft: Indices of the traces to be reconstructed in all events, or a boolean
+                 array of shape (events, traces), which is True for the traces to be
+                 reconstructed in each event
+    :type  noft: list or numpy.ndarray
+
+    :param maxiter: Maximum number of iterations
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param method: Decrease of the threshold, 'linear' or 'exp'
+    :type  method: string
+
+    :param tol: Tolerance of the convergence test, see pocs_engine. Events that
+                converged are not updated anymore.
+    :type  tol: float
+
+    :param callback: Function called after each iteration as callback(i, datap)
+    :type  callback: function
+
+    returns:
+
+    :param datap: Reconstructed data, same shape as data
+    :type  datap: numpy.ndarray
+
+    :param niter: Number of iterations done for each event
+    :type  niter: numpy.ndarray
+    """
+    data = np.asarray(data, dtype='float')
+    if data.ndim != 3:
+        raise IOError('data must have the shape (events, traces, samples)')
+    nev, ix, it = data.shape
+
+    missing = np.zeros((nev, ix), dtype='bool')
+    noft = np.asarray(noft)
+    if noft.dtype == bool:
+        if noft.shape != (nev, ix):
+            raise IOError('Boolean noft must have the shape (events, traces)')
+        missing[:] = noft
+    elif noft.size:
+        missing[:, noft.astype('int')] = True
+
+    shape = fftutil.fast_shape((ix, it))
+    window = (slice(None), slice(0, ix), slice(0, it))
+
+    # Preallocate the padded stack and the buffers of the half spectra.
+    buf = np.zeros((nev,) + shape)
+    buf[window] = data
+    datap = buf[window]
+    spec_shape = (nev, shape[0], shape[1] // 2 + 1)
+    mag = np.empty(spec_shape)
+    mag_imag = np.empty(spec_shape)
+    kill = np.empty(spec_shape, dtype='bool')
+    update = missing[:, :, np.newaxis]
+    active = np.ones(nev, dtype='bool')
+    niter = np.zeros(nev, dtype='int')
+    if tol:
+        old = np.empty(data.shape)
+
+    # Start thresholds of each event, squared as in pocs_engine.
+    fkmax = fftutil.rfft2(buf).reshape(nev, -1).max(axis=1)
+    threshold2 = (np.square(fkmax.real) + np.square(fkmax.imag))[:, np.newaxis, np.newaxis]
+
+    for i in range(maxiter):
+        fkdata = fftutil.rfft2(buf)
+        np.square(fkdata.real, out=mag)
+        np.square(fkdata.imag, out=mag_imag)
+        mag += mag_imag
+        np.less(mag, threshold2, out=kill)
+        np.copyto(fkdata, 0., where=kill)
+
+        if method in ('linear'):
+            threshold2 = threshold2 * alpha**2.
+        elif method in ('exp'):
+            threshold2 = threshold2 * np.exp(-(i+1) * alpha)**2.
+
+        if tol:
+            old[:] = datap
+        np.copyto(datap, fftutil.irfft2(fkdata, s=shape)[window], where=update)
+        niter[active] = i + 1
+
+        if callback:
+            callback(i, datap)
+
+        if tol:
+            change = np.sqrt((np.square(datap - old) * update).sum(axis=(1, 2)))
+            norm = np.sqrt((np.square(datap) * update).sum(axis=(1, 2)))
+            active &= ~(change <= tol * norm)
+            update = missing[:, :, np.newaxis] & active[:, np.newaxis, np.newaxis]
+            if not active.any():
+                break
+
+    return datap.copy(), niter
+
+
+def pocs_tiled(data, noft, maxiter, alpha, method='linear', patch=None, overlap=0.5, tol=None, workers=None,
+               threshold=None):
+    """
+    Tiled version of pocs_engine. The data are split into overlapping patches along
+    all axes, e.g. trace (distance) and time, or y, x and time for the grids of
+    pocs3d. Each patch is reconstructed on its own, with
+    its own start threshold, and the patches are merged by overlap-add with sin^2
+    tapers across the overlaps. Patches without traces to reconstruct are skipped.
+
+    With workers > 1 the patches are reconstructed on a pool of processes. The data
+    are placed once in shared memory, each process only allocates the work arrays
+    of one patch.
+
+    :param data: Data with zero-filled traces to be reconstructed
+    :type  data: numpy.ndarray
+
+    :param noft: Indices of the traces to be reconstructed, or a boolean mask of the
+                 leading axes of data
+    :type  noft: list or numpy.ndarray
+
+    :param maxiter: Maximum number of iterations
+    :type  maxiter: int
+
+    :param alpha: Factor of threshold decrease after each iteration
+    :type  alpha: float
+
+    :param method: Decrease of the threshold, 'linear' or 'exp'
+    :type  method: string
+
+    :param patch: Size of a patch along each axis, default is the whole size of the
+                  leading axes and a third of the samples
+    :type  patch: tuple
+
+    :param overlap: Overlap of neighbouring patches, as part of the patch size
+    :type  overlap: float
+
+    :param tol: Tolerance of the convergence test, see pocs_engine
+    :type  tol: float
+
+    :param workers: Number of processes, default is a serial run
+    :type  workers: int
+
+    :param threshold: Start threshold of each patch, relative to the maximum of the
+                      spectrum of the patch, default is 1
+    :type  threshold: float
+
+    returns:
+
+    :param datap: Reconstructed data, same shape as data
+    :type  datap: numpy.ndarray
+    """
+    if patch is None:
+        patch = data.shape[:-1] + (max(1, data.shape[-1] // 3),)
+    noft = np.asarray(noft)
+    if noft.dtype == bool:
+        missing = noft
+    else:
+        missing = np.zeros(data.shape[:-1], dtype='bool')
+        missing[noft.astype('int')] = True
+
+    tiles = [patch_tiles(n, length, overlap) for n, length in zip(data.shape, patch)]
+    tasks = []
+    for stiles in product(*tiles[:-1]):
+        bounds = tuple((start, stop) for start, stop, w in stiles)
+        rows = missing[tuple(slice(start, stop) for start, stop in bounds)]
+        if not rows.any():
+            continue
+        for t0, t1, tw in tiles[-1]:
+            tasks.append((bounds + ((t0, t1),), rows))
+
+    datap = data.astype('float')
+    if not tasks:
+        return datap
+
+    args = (maxiter, alpha, method, tol, threshold)
+    if not workers or workers == 1:
+        results = (_pocs_patch(data, task, args) for task in tasks)
+        executor = None
+    else:
+        shm = to_shared_memory(data)
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_pocs_patch_init,
+                                       initargs=(shm.name, data.shape, args))
+        results = executor.map(_pocs_patch_shared, tasks)
+
+    try:
+        acc = np.zeros(data.shape)
+        wsum = np.zeros(data.shape)
+        weights = [dict((start, w) for start, stop, w in axtiles) for axtiles in tiles]
+        for (bounds, rows), rec in zip(tasks, results):
+            w = reduce(np.multiply.outer, [weights[axis][start] for axis, (start, stop) in enumerate(bounds)])
+            window = tuple(slice(start, stop) for start, stop in bounds)
+            acc[window] += w * rec
+            wsum[window] += w
+    finally:
+        if executor is not None:
+            executor.shutdown()
+            shm.close()
+            shm.unlink()
+
+    datap[missing] = acc[missing] / wsum[missing]
+
+    return datap
+
+
+def _pocs_patch(data, task, args):
+    bounds, rows = task
+    maxiter, alpha, method, tol, level = args
+    data = data[tuple(slice(start, stop) for start, stop in bounds)]
+    threshold = None
+    if level is not None:
+        threshold = level * abs(fftutil.rfftn(data, s=fftutil.fast_shape(data.shape)).max())
+    return pocs_engine(data, rows, maxiter, alpha, method, threshold=threshold, tol=tol)[0]
+
+
+# Shared input of the processes of pocs_tiled, set by _pocs_patch_init.
+_POCS_PATCH_SHARED = {}
+
+
+def _pocs_patch_init(name, shape, args):
+    # One FFT thread per process, the processes already use all cores.
+    fftutil.set_workers(1)
+    shm = shared_memory.SharedMemory(name=name)
+    _POCS_PATCH_SHARED.update(shm=shm, args=args, data=np.ndarray(shape, dtype='float', buffer=shm.buf))
+
+
+def _pocs_patch_shared(task):
+    return _pocs_patch(_POCS_PATCH_SHARED['data'], task, _POCS_PATCH_SHARED['args'])
+
+
+def to_shared_memory(array):
+    """
+    Copies array as float to a new block of shared memory and returns the block.
+    The caller has to close and unlink it.
+
+    :param array: Array to be shared
+    :type  array: numpy.ndarray
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.size * 8, 1))
+    np.ndarray(array.shape, dtype='float', buffer=shm.buf)[:] = array
+    return shm
+
+
+def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='denoise', peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, overlap=0.5, plotfeedback=False, tol=None, callback=None,
+         patch=None, workers=None, x0=None, threshold=None, multigrid=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros. It applies the projection onto convex sets (pocs) algorithm in
@@ -1144,6 +2101,44 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
     :param maskshape: Shape of the corners of mask, see makemask
 
+    :param slidingwindow: If True, 'linear' and 'exp' work on overlapping patches of
+                          the data, see pocs_tiled
+    :type  slidingwindow: bool
+
+    :param overlap: Overlap of the patches, as part of the patch size
+    :type  overlap: float
+
+    :param patch: Number of traces and samples of a patch, see pocs_tiled
+    :type  patch: tuple
+
+    :param workers: Number of processes reconstructing the patches, see pocs_tiled
+    :type  workers: int
+
+    :param tol: Tolerance of the convergence test for 'linear' and 'exp', the iteration
+                stops early if the relative change of the reconstructed traces is below
+                tol, see pocs_engine
+    :type  tol: float
+
+    :param callback: Function called as callback(i, datap) after every iteration of
+                     'linear' and 'exp' with dmethod 'reconstruct', see pocs_engine.
+                     datap must not be modified or stored by callback, copy it if needed.
+    :type  callback: function
+
+    :param x0: Initial guess of the traces in noft, e.g. a previous reconstruction of the
+               same array, same shape and in the same units as data, e.g. normalized as
+               data. Only its rows in noft are used, default are the zero-filled traces
+               of data.
+    :type  x0: numpy.ndarray
+
+    :param threshold: Start threshold of 'linear', 'exp' and 'mask', relative to the maximum
+                      of the spectrum, default is 1. A lower start, e.g. together with x0,
+                      skips the first iterations.
+    :type  threshold: float
+
+    :param multigrid: Number of levels of a coarse-to-fine reconstruction with 'linear' and
+                      'exp', see pocs_multigrid. maxiter is then split between the levels.
+    :type  multigrid: int
+
     returns:
 
     :param datap:
@@ -1154,11 +2149,18 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
     #	raise IOError(msg)
 
     ArrayData 	= data.copy()
+    if x0 is not None:
+        x0 = np.asarray(x0)
+        if x0.shape != ArrayData.shape:
+            raise IOError('Shapes of x0 and data differ!')
+        ArrayData[noft] = x0[noft]
+
     ix = ArrayData.shape[0]
-    iK = int(math.pow(2,nextpow2(ix)))
+    iK = fftutil.fast_len(ix)
     it = ArrayData.shape[1]
-    iF = int(math.pow(2,nextpow2(it)))
-    fkdata = np.fft.fft2(ArrayData, s=(iK,iF))
+    iF = fftutil.fast_len(it)
+    fkdata = fftutil.fft2(ArrayData, s=(iK,iF))
+    level = threshold
     threshold = abs(fkdata.max())
 
     ADold = ArrayData.copy()
@@ -1167,42 +2169,7 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
     if method in ('linear', 'exp'):
         if slidingwindow:
             if dmethod in ('reconstruct'):
-                w_length = int(data.shape[1] / 3.)
-                swh = np.hanning(w_length)
-
-                loc = 0.
-                inside = True
-                while inside:
-                    curr_win = int(loc)
-                    ADtemp = ArrayData[:,curr_win:curr_win+w_length].copy()
-
-                    for i in range(maxiter):
-                        data_tmp 	= ADtemp.copy()
-                        fkdata 		= np.fft.fft2(data_tmp, s=(iK,iF))
-                        fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
-
-                        if method in ('linear'):
-                            threshold 	= threshold * alpha
-                        elif method in ('exp'):
-                            threshold 	= threshold * sp.exp(-(i+1) * alpha)
-
-                        data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
-                        ADtemp[noft] 	= data_tmp[noft][:,curr_win:curr_win+w_length].copy()
-
-
-
-                    if loc == 0.:
-                        ADfinal[:,curr_win:curr_win+w_length] = ADtemp.copy()
-                    else:
-                        ADfinal[:,curr_win:curr_win+w_length] = ADfinal[:,curr_win:curr_win+w_length] + ADtemp
-                        ADfinal[:,curr_win-int(overlap*w_length):int(curr_win)] = ( ADold[:,int((1-overlap)*w_length):] + ADtemp[:,:int(overlap*w_length)] ) / 2.
-
-                    ADold = ADtemp.copy()
-                    threshold = abs(np.fft.fft2(ADold, s=(iK,iF)).max())
-
-                    loc += overlap * w_length
-                    print(loc)
-                    if loc >= data.shape[1]: inside=False
+                ADfinal = pocs_tiled(ArrayData, noft, maxiter, alpha, method, patch, overlap, tol, workers, level)
 
         else:
             if dmethod in ('denoise', 'de-noise'):
@@ -1229,87 +2196,77 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
                 # threshold = abs(np.fft.fft2(ADfinal, s=(iK,iF)).max())
 
             elif dmethod in ('reconstruct', 'Reconstruct'):
-                ADtemp = ArrayData.copy()
-                for i in range(maxiter):
-                    data_tmp 	= ADtemp.copy()
-                    fkdata 		= np.fft.fft2(data_tmp, s=(iK,iF))
-                    fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
-
-                    if method in ('linear'):
-                        threshold 	= threshold * alpha
-                    elif method in ('exp'):
-                        threshold 	= threshold * sp.exp(-(i+1) * alpha)
-
-                    data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
-                    ADtemp[noft] 	= data_tmp[noft]
-                    if plotfeedback:
+                feedback = callback
+                if plotfeedback:
+                    def feedback(i, ADtemp):
                         print('plotting')
                         plot(ADtemp, newfigure=False)
                         time.sleep(2)
+                        if callback:
+                            callback(i, ADtemp)
 
-
-                ADfinal = ADtemp.copy()
-
-                threshold = abs(np.fft.fft2(ADfinal, s=(iK,iF)).max())
+                if multigrid and multigrid > 1:
+                    ADfinal, niter = pocs_multigrid(ArrayData, noft, maxiter, alpha, method, levels=multigrid,
+                                                    threshold=level, tol=tol, callback=feedback)
+                else:
+                    if level is not None:
+                        threshold = level * threshold
+                    else:
+                        threshold = None
+                    ADfinal, niter = pocs_engine(ArrayData, noft, maxiter, alpha, method, threshold=threshold,
+                                                 shape=(iK,iF), tol=tol, callback=feedback)
 
 
 
     elif method in ('mask'):
         W 		= makeMask(fkdata, peaks[0], maskshape)
-        ADfinal = ArrayData.copy()
-        for n in noft:
-            ADtemp 	= ArrayData.copy()
-            threshold = abs(W*np.fft.fft2(ADfinal, s=(iK,iF))).max()
-            for i in range(maxiter):
-                data_tmp 	=ADtemp.copy()
-                fkdata 		= W * np.fft.fft2(data_tmp, s=(iK,iF))
-                fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
-                threshold 	= threshold * alpha
-                data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
-                ADtemp[n] 	= data_tmp[n]
-
-            ADfinal[n] = ADtemp[n].copy()
+        ADtemp 	= ArrayData.copy()
+        threshold = abs(W*fkdata).max()
+        if level is not None:
+            threshold = level * threshold
+        for i in range(maxiter):
+            fkdata 		= W * fftutil.fft2(ADtemp, s=(iK,iF))
+            fkdata[ abs(fkdata) < threshold ] 	= 0. + 0j
+            threshold 	= threshold * alpha
+            data_tmp 	= fftutil.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it]
+            ADtemp[noft] 	= data_tmp[noft]
+
+        ADfinal = ADtemp
 
     elif method in ('ssa'):
+        ADtemp 	= ArrayData.copy()
+        for i in range(maxiter):
+            data_ssa 		= fx_ssa(ADtemp.transpose(),dt,p,flow,fhigh).transpose()
+            ADtemp 			= alpha * ADtemp
+            ADtemp[noft] 	= (1. - alpha) * data_ssa[noft]
 
-        for n in noft:
-            for i in range(maxiter):
-                data_tmp 		= ArrayData.copy()
-                data_ssa 		= fx_ssa(data_tmp,dt,p,flow,fhigh)
-                ArrayData 		= alpha * ArrayData
-                ArrayData[n] 	= (1. - alpha) * data_ssa[n]
-
-            ADfinal[n] = ArrayData[n].copy()
+        ADfinal = ArrayData.copy()
+        ADfinal[noft] = ADtemp[noft]
 
     elif method in ('average'):
-        threshold = beta * abs(np.fft.fft2(ArrayData, s=(iK,iF)).max())
+        threshold = beta * abs(fkdata.max())
         ADtemp = ArrayData.copy()
-        for n in noft:
-            for i in range(maxiter):
-                data_tmp 	= ADtemp.copy()
-                fkdata 		= np.fft.fft2(data_tmp, s=(iK,iF))
-                fkdata[ np.where(abs(fkdata) < threshold)] 	= 0. + 0j
+        for i in range(maxiter):
+            fkdata 		= fftutil.fft2(ADtemp, s=(iK,iF))
+            fkdata[ abs(fkdata) < threshold ] 	= 0. + 0j
+            data_tmp 	= fftutil.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it]
 
-                ADtemp 		= alpha*data_tmp + (1. - alpha) * np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it]
-                ADtemp[n] 	= (1. - alpha) * np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it][n]
+            ADtemp 		= alpha*ADtemp + (1. - alpha) * data_tmp
+            ADtemp[noft] 	= (1. - alpha) * data_tmp[noft]
 
-            ADfinal = ADtemp.copy()
+        ADfinal = ADtemp
 
 
     elif method == 'maskvary':
-
-        ADfinal = ArrayData.copy()
         ADtemp 	= ArrayData.copy()
-        for n in noft:
-            for i in range(maxiter):
-                W 			= makeMask(fkdata, peaks, shape=maskshape, expl_cutoff=i)
-                data_tmp 	= ADtemp.copy()
-                fkdata 		= W * np.fft.fft2(data_tmp, s=(iK,iF))
-                data_tmp 	= np.fft.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it].copy()
-                ADtemp[n]	= alpha * ArrayData[n].copy()
-                ADtemp[n]  += (1. - alpha) * data_tmp[n]
+        for i in range(maxiter):
+            W 			= makeMask(fkdata, peaks[0], shape=maskshape, expl_cutoff=i)
+            fkdata 		= W * fftutil.fft2(ADtemp, s=(iK,iF))
+            data_tmp 	= fftutil.ifft2(fkdata, s=(iK,iF)).real[0:ix, 0:it]
+            ADtemp[noft]	= alpha * ArrayData[noft] + (1. - alpha) * data_tmp[noft]
 
-            ADfinal[n] = ArrayData[n].copy()
+        ADfinal = ArrayData.copy()
+        ADfinal[noft] = ADtemp[noft]
 
     else:
         print('no method specified')
@@ -1331,6 +2288,27 @@ def shift_array(array, shift_value=0, y_dist=False):
     return(array_shift)
 
 
+@lru_cache(maxsize=32)
+def _shear_index_table(shape, pmin, pmax, pdelta):
+    """
+    Returns the slopes in the range pmin to pmax with stepsize pdelta and the
+    table of k indices, shape (slopes, frequencies), that moves the spectrum
+    entry of a slope at every frequency into the k=0 row, as used by
+    slope_distribution. The tables are cached per (shape, prange, pdelta).
+    """
+    pnorm = 1/2. * ( float(shape[0])/float(shape[1]) )
+
+    N = int(round(abs(pmax - pmin) / pdelta)) + 1
+    srange = np.linspace(pmin, pmax, N)
+
+    p = srange * pnorm
+    shift_table = np.mod(-np.floor(np.outer(p, np.arange(shape[1]))).astype('int'), shape[0])
+
+    shift_table.setflags(write=False)
+
+    return srange, shift_table
+
+
 def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0, smoothing=False, interactive=False):
     """
     Generates a distribution of slopes in a range given in prange.
@@ -1387,30 +2365,20 @@ def slope_distribution(fkdata, prange, pdelta, peakpick=None, delta_threshold=0,
     :type peaks: numpy.ndarray
     """
 
-    M = fkdata.copy()
-    Mt = M.conj().transpose()
-    fk_shift =	np.zeros(M.shape).astype('complex')
-
-    pnorm = 1/2. * ( float(M.shape[0])/float(M.shape[1]) )
-
+    M = np.abs(fkdata)
     pmin = prange[0]
     pmax = prange[1]
-    N = abs(pmax - pmin) / pdelta + 1
-    MD = np.zeros(N)
-    srange = np.linspace(pmin,pmax,N)
-
-    rend = float( len(srange) )
-    for i, delta in enumerate(srange):
-
-        p = delta*pnorm
-        for j, trace in enumerate(Mt):
-            shift = int(math.floor(p*j))
-            fk_shift[:,j] = np.roll(trace, shift)
-        MD[i] = sum(abs(fk_shift[0,:])) / len(fk_shift[0,:])
-
-        prcnt = 100*(i+1) / rend
-        print("%i %% done" % prcnt, end="\r")
-        sys.stdout.flush()
+    srange, shift_table = _shear_index_table(M.shape, float(pmin), float(pmax), float(pdelta))
+    srange = srange.copy()
+
+    # Shearing the spectrum by the slope p and reading the k=0 row is a gather
+    # of M[-floor(p*j) mod nk, j] over all frequency columns j, done for a batch
+    # of slopes at a time to keep the memory bounded.
+    cols = np.arange(M.shape[1])
+    MD = np.zeros(srange.size)
+    nbatch = max(1, 2**22 // M.shape[1])
+    for i in range(0, srange.size, nbatch):
+        MD[i:i+nbatch] = M[shift_table[i:i+nbatch], cols].mean(axis=1)
 
     if interactive:
 
@@ -8,14 +8,14 @@ import matplotlib.pyplot as plt
 import sys
 
 from bowpy.util.base import stream2array, array2stream
-from bowpy.filter.fk import pocs_recon
+from bowpy.filter.fk import pocs_q_surface
 from bowpy.util.array_util import stack
 from bowpy.util.fkutil import plot
 # If using a Mac Machine, otherwitse comment the next line out:
 matplotlib.use('TkAgg')
 
 
-def qtest_pocs(st_rec, st_orginal, alpharange, irange):
+def qtest_pocs(st_rec, st_orginal, alpharange, irange, workers=None):
     """
     Runs the selected method in a certain range of parameters
     (iterations and alpha), returns a table of Q values ,defined as:
@@ -23,30 +23,16 @@ def qtest_pocs(st_rec, st_orginal, alpharange, irange):
     Q = 10 * log( || d_org || ^2 _2  / ||  d_org - d_rec || ^2 _2 )
 
     The highest Q value is the one to be chosen.
+    One pocs run per alpha is done, on workers processes,
+    see bowpy.filter.fk.pocs_q_surface.
     """
-    Qall = []
     dmethod = 'reconstruct'
     method = 'linear'
 
-    st_org = st_orginal.copy()
-    data_org = stream2array(st_org, normalize=True)
-
-    for alpha in alpharange:
-
-        print("########## CURRENT ALPHA %f  ##########\n" % alpha)
-        for i in irange:
-
-            print('POCS RECON WITH %i ITERATIONS' % i, end="\r")
-            sys.stdout.flush()
-            srs = st_rec.copy()
-            st_pocsrec = pocs_recon(srs, maxiter=int(i), method=method,
-                                    dmethod=dmethod, alpha=alpha)
-            drec = stream2array(st_pocsrec, normalize=True)
-            Q_tmp = np.linalg.norm(data_org, 2)**2. / np.linalg.norm(data_org
-                                                                     - drec,
-                                                                     2)**2.
-            Q = 10.*np.log(Q_tmp)
-            Qall.append([alpha, i, Q])
+    data_org = stream2array(st_orginal, normalize=True)
+
+    Qall = pocs_q_surface(st_rec, alpharange, irange, data_org, normalize=True,
+                          method=method, dmethod=dmethod, workers=workers)
 
     Qmax = [0, 0, 0]
     for i in Qall: